@@ -0,0 +1,848 @@
+from __future__ import print_function
+
+# Benchmarks for plyxproto. Run all of them with `python bench.py`, or pick
+# some by name, e.g. `python bench.py startup`.
+
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+benchmarks = []
+
+
+def benchmark(f):
+    benchmarks.append(f)
+    return f
+
+
+def synthetic(messages=10, fields=10):
+    out = ['package bench;', 'option app_label = "bench";', '']
+    for m in range(messages):
+        out.append('policy p%d < ctx.user.is_admin | exists Privilege: '
+                   'Privilege.object_id = obj.id >' % m)
+        out.append('message Model%d::p%d (XOSBase) {' % (m, m))
+        for f in range(fields):
+            if f % 4 == 3:
+                out.append('     optional manytoone link%d->Model%d:back%d = '
+                           '%d [null = True, blank = True];' % (f, m, f, f + 1))
+            else:
+                out.append('     required string field%d = %d [max_length = '
+                           '200, default = "x", null = False];' % (f, f + 1))
+        out.append('}')
+        out.append('')
+    return '\n'.join(out)
+
+
+# Exercises every kind of top-level statement and field the grammar has.
+SAMPLE = '''
+option app_label = "core";
+option legacy = True;
+import "foo/bar.xproto";
+
+/* A block
+   comment spanning lines */
+policy site_policy < ctx.user.is_admin | exists Privilege: Privilege.object_id = obj.id & Privilege.accessor_id = ctx.user.id >
+policy slice_policy < *site_policy(site) | {{ obj.name.endswith('x') }} >
+policy neg < not (a = b) -> forall x: x in y >
+
+message XOSBase {
+     optional string name = 1 [max_length = 200, null = True, blank = False, default = "foo"];
+     required int32 backend_need_delete = 2 [default = 0];
+     optional manytoone owner->User:owned_objects = 3 [null = True];
+     required manytoone site->Site:instances = 4 [db_index = True, blank = False];
+     optional manytomany tags->Tag/XOSBase_tags:tagged = 5;
+     required onetoone cred->Credential:object = 6:1006;
+     required string max = 7;
+     required string message = 8;
+     optional float ratio = 9 [default = 1.5];
+     required int64 n = 10 [default = -3];
+}
+
+message Slice::slice_policy (XOSBase, core.PlModelMixIn) {
+     required string name = 1 [max_length = 80, unique = True];
+     required manytoone site->Site:slices = 2 [help_text = "The Site this Slice belongs to"];
+     required string policy_field::neg = 3;
+     enum Kind { A = 1; B = 2; option allow_alias = true; }
+     option verbose_name = "Slice";
+}
+
+extend Slice {
+  optional int32 extra = 100;
+}
+
+enum Empty {}
+message EmptyMsg {}
+
+map m1 <lambda x: x+1>
+reduce r1 <lambda x, y: x + y>
+
+_service Svc {
+  rpc Get(Req) returns (Resp)
+  rpc Put(Req) returns (Resp)
+}
+package a.b.c;
+'''
+
+
+def corpus():
+    return [SAMPLE, synthetic(5, 12)]
+
+
+def best_of(n, f):
+    best = None
+    for _ in range(n):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType,
+                types.BuiltinFunctionType, types.MethodType)
+
+
+def reachable_size(root):
+    seen = set()
+    stack = [root]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+def retained_memory(build):
+    """Bytes still allocated by the objects build() returns."""
+    try:
+        import tracemalloc
+    except ImportError:
+        keep = build()
+        return reachable_size(keep)
+    gc.collect()
+    tracemalloc.start()
+    keep = build()
+    gc.collect()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    return current
+
+
+STARTUP_SCRIPT = '''
+import time
+start = time.time()
+import plyxproto.parser as plyproto
+plyproto.ProtobufAnalyzer().parse_string(%r)
+print(time.time() - start)
+'''
+
+
+@benchmark
+def startup():
+    script = STARTUP_SCRIPT % synthetic(1, 5)
+    cachedir = tempfile.mkdtemp(prefix='plyxproto-bench-')
+    env = dict(os.environ, PLYXPROTO_CACHE_DIR=cachedir)
+
+    def run():
+        out = subprocess.check_output([sys.executable, '-c', script],
+                                      cwd=HERE, env=env)
+        return float(out.decode().strip().splitlines()[-1])
+
+    try:
+        cold = run()
+        warm = min(run() for _ in range(5))
+    finally:
+        shutil.rmtree(cachedir)
+    print('startup: import + first parse, cold cache %.1f ms, '
+          'warm cache %.1f ms' % (cold * 1e3, warm * 1e3))
+
+
+IMPORT_SCRIPT = '''
+import time
+start = time.time()
+import plyxproto.parser as plyproto
+elapsed = time.time() - start
+assert plyproto.ProtobufParser._fol is None, 'policy parser built at import'
+print(elapsed)
+'''
+
+
+@benchmark
+def importtime():
+    def run():
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                      cwd=HERE)
+        return float(out.decode().strip().splitlines()[-1])
+
+    print('importtime: import plyxproto.parser %.1f ms (policy parser not '
+          'built)' % (min(run() for _ in range(5)) * 1e3))
+
+
+@benchmark
+def batch():
+    import multiprocessing
+    from plyxproto.batch import parse_files
+
+    tmpdir = tempfile.mkdtemp(prefix='plyxproto-bench-')
+    try:
+        paths = []
+        for i in range(400):
+            path = os.path.join(tmpdir, 'm%d.xproto' % i)
+            with open(path, 'w') as f:
+                f.write(synthetic(2, 8))
+            paths.append(path)
+        with open(paths[7], 'a') as f:
+            f.write('message Broken { = }')
+
+        jobs = max(2, multiprocessing.cpu_count())
+        start = time.time()
+        serial = parse_files(paths, jobs=1)
+        serial_time = time.time() - start
+        start = time.time()
+        parallel = parse_files(paths, jobs=jobs)
+        parallel_time = time.time() - start
+    finally:
+        shutil.rmtree(tmpdir)
+
+    assert [r.path for r in parallel] == paths
+    assert [r.error is None for r in parallel] == \
+        [r.error is None for r in serial]
+    assert sum(r.error is not None for r in parallel) == 1
+    print('batch: %d files, serial %.2f s, %d jobs %.2f s' %
+          (len(paths), serial_time, jobs, parallel_time))
+
+
+@benchmark
+def lean():
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufGrammar
+
+    grammar = ProtobufGrammar()
+    sources = [synthetic(2, 8) + '\n// file %d\n' % i for i in range(50)]
+
+    def build(lean):
+        analyzer = ProtobufAnalyzer(grammar=grammar, lean=lean)
+        return lambda: [analyzer.parse_string(src) for src in sources]
+
+    full = retained_memory(build(False))
+    lean = retained_memory(build(True))
+    print('lean: %.1f KB per file with parser references, %.1f KB lean '
+          '(%.1f KB saved)' % (full / 1024.0 / len(sources),
+                               lean / 1024.0 / len(sources),
+                               (full - lean) / 1024.0 / len(sources)))
+
+
+@benchmark
+def nodes():
+    from plyxproto.helpers import Base
+    from plyxproto.parser import ProtobufAnalyzer
+
+    analyzer = ProtobufAnalyzer(lean=True)
+    src = synthetic(20, 10)
+    count = 0
+    seen = set()
+    stack = [analyzer.parse_string(src)]
+    while stack:
+        obj = stack.pop()
+        if id(obj) not in seen and not isinstance(obj, SHARED_TYPES):
+            seen.add(id(obj))
+            stack.extend(gc.get_referents(obj))
+            count += isinstance(obj, Base)
+    size = retained_memory(lambda: analyzer.parse_string(src))
+    elapsed = best_of(5, lambda: analyzer.parse_string(src))
+    print('nodes: %d nodes, %.0f bytes per node, %.1f ms to build' %
+          (count, float(size) / count, elapsed * 1e3))
+
+
+@benchmark
+def scaling():
+    from plyxproto.parser import ProtobufAnalyzer
+
+    analyzer = ProtobufAnalyzer(lean=True)
+    for n in (10, 100, 1000, 10000, 100000):
+        fields = ''.join('  required string f%d = %d;\n' % (i, i + 1)
+                         for i in range(n))
+        src = 'message Wide {\n%s}\n' % fields
+        elapsed = best_of(1 if n >= 10000 else 3,
+                          lambda: analyzer.parse_string(src))
+        print('scaling: %6d fields %9.1f ms, %.1f us per field' %
+              (n, elapsed * 1e3, elapsed * 1e6 / n))
+
+
+@benchmark
+def spans():
+    from ply.yacc import YaccProduction
+    from plyxproto.helpers import LexHelper
+    from plyxproto.parser import ProtobufAnalyzer
+
+    productions = []
+    set_parse_object = LexHelper.set_parse_object
+
+    def record(self, dst, p):
+        productions.append(YaccProduction(list(p.slice)))
+        set_parse_object(self, dst, p)
+
+    LexHelper.set_parse_object = record
+    try:
+        analyzer = ProtobufAnalyzer(lean=True)
+        for src in corpus():
+            analyzer.parse_string(src)
+    finally:
+        LexHelper.set_parse_object = set_parse_object
+
+    lh = LexHelper()
+    for p in productions:
+        assert lh.get_spans(p) == \
+            (lh.get_max_linespan(p), lh.get_max_lexspan(p)), p.slice
+
+    def two_pass():
+        for p in productions:
+            lh.get_max_linespan(p)
+            lh.get_max_lexspan(p)
+
+    def one_pass():
+        for p in productions:
+            lh.get_spans(p)
+
+    n = len(productions)
+    print('spans: %d reductions agree, two passes %.2f us, one pass %.2f us '
+          'per reduction' % (n, best_of(5, two_pass) * 1e6 / n,
+                             best_of(5, one_pass) * 1e6 / n))
+
+
+@benchmark
+def pathological():
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufGrammar
+
+    analyzer = ProtobufAnalyzer(lean=True)
+    lexer = ProtobufGrammar().lexer.clone()
+
+    def tokens(src):
+        lexer.input(src)
+        while lexer.token() is not None:
+            pass
+
+    comment = '/*' + 'commented out = 1;\n' * 55000 + '*/\n' + SAMPLE
+    escape = ' & '.join('{{ obj.f%d -> x }}' % i for i in range(5000))
+    policy = 'policy big < %s >\n%s' % (escape, SAMPLE)
+    unterminated = '/* < {{\n' * 20000
+
+    cases = [('1 MB comment', lambda: analyzer.parse_string(comment)),
+             ('100 KB policy', lambda: analyzer.parse_string(policy)),
+             ('unterminated openers', lambda: tokens(unterminated))]
+    sizes = [len(comment), len(policy), len(unterminated)]
+    for (name, run), size in zip(cases, sizes):
+        elapsed = best_of(3, run)
+        # A linear scan stays far below this; backtracking does not.
+        assert elapsed < 2e-6 * size + 0.5, (name, elapsed)
+        print('pathological: %s (%d KB) %.1f ms' %
+              (name, size // 1024, elapsed * 1e3))
+
+
+@benchmark
+def scanner():
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufGrammar
+
+    def stream(lexer, src):
+        lexer = lexer.clone()
+        lexer.input(src)
+        return [(t.type, t.value, t.lineno, t.lexpos) for t in lexer]
+
+    ply = ProtobufGrammar(backend='ply')
+    hand = ProtobufGrammar(backend='scanner')
+    for src in corpus():
+        assert stream(ply.lexer, src) == stream(hand.lexer, src)
+
+    def drain(lexer, src):
+        lexer.input(src)
+        token = lexer.token
+        while token() is not None:
+            pass
+
+    src = synthetic(50, 20)
+    count = len(stream(ply.lexer, src))
+    for grammar in (ply, hand):
+        lexer = grammar.lexer.clone()
+        lexing = best_of(5, lambda: drain(lexer, src))
+        analyzer = ProtobufAnalyzer(grammar=grammar, lean=True)
+        parsing = best_of(3, lambda: analyzer.parse_string(src))
+        print('scanner: %-13s %7.0f tokens/s, parse %.1f ms' %
+              (grammar.lexer.__class__.__name__, count / lexing,
+               parsing * 1e3))
+
+
+@benchmark
+def source():
+    from plyxproto.source import read_source
+
+    def line_by_line(path):
+        content = ''
+        with open(path) as f:
+            for line in f:
+                content += line
+        return content
+
+    tmpdir = tempfile.mkdtemp(prefix='plyxproto-bench-')
+    try:
+        for messages in (500, 2000):
+            path = os.path.join(tmpdir, 'big%d.xproto' % messages)
+            with open(path, 'w') as f:
+                f.write(synthetic(messages, 40))
+            size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            assert read_source(path) == line_by_line(path) == \
+                read_source(memoryview(data))
+
+            old = best_of(3, lambda: line_by_line(path))
+            new = best_of(3, lambda: read_source(path))
+            print('source: %.1f MB, line by line %.1f ms, read_source %.1f ms'
+                  % (size / 1048576.0, old * 1e3, new * 1e3))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def tokenbuffer():
+    from plyxproto.parser import ProtobufAnalyzer
+
+    analyzer = ProtobufAnalyzer(lean=True, backend='scanner')
+    src = synthetic(50, 20)
+    buf = analyzer.tokenize_buffer(src)
+    assert [(t.type, t.value, t.lineno, t.lexpos) for t in buf] == \
+        [(t.type, t.value, t.lineno, t.lexpos)
+         for t in analyzer.iter_tokens(src)]
+
+    objects = retained_memory(lambda: list(analyzer.iter_tokens(src)))
+    compact = retained_memory(lambda: analyzer.tokenize_buffer(src))
+    build = best_of(5, lambda: analyzer.tokenize_buffer(src))
+    parse = best_of(3, lambda: analyzer.parse_tokens(buf))
+    print('tokenbuffer: %d tokens, %.0f KB as LexTokens, %.0f KB buffered '
+          '(incl. source), built in %.1f ms, parsed in %.1f ms' %
+          (len(buf), objects / 1024.0, compact / 1024.0, build * 1e3,
+           parse * 1e3))
+
+
+@benchmark
+def lines():
+    import random
+    from plyxproto.source import LineTable
+
+    src = synthetic(500, 40)
+    positions = [random.randrange(len(src)) for _ in range(5000)]
+
+    def rescan(pos):
+        start = src.rfind('\n', 0, pos) + 1
+        return (src.count('\n', 0, pos) + 1, pos - start + 1)
+
+    table = LineTable(src)
+    assert [table.position(p) for p in positions] == \
+        [rescan(p) for p in positions]
+
+    scan = best_of(3, lambda: [rescan(p) for p in positions])
+    build = best_of(3, lambda: LineTable(src))
+    lookup = best_of(3, lambda: [table.position(p) for p in positions])
+    print('lines: %d lookups in %.1f MB, rescanning %.1f ms, line table '
+          '%.1f ms (+ %.1f ms to build)' %
+          (len(positions), len(src) / 1048576.0, scan * 1e3, lookup * 1e3,
+           build * 1e3))
+
+
+@benchmark
+def binary():
+    import random
+    from plyxproto.parser import ProtobufAnalyzer
+
+    rnd = random.Random(0)
+    data = bytearray(rnd.randrange(256) for _ in range(256 * 1024))
+    src = bytes(data) if bytes is str else data.decode('latin-1')
+    for backend in ('ply', 'scanner'):
+        analyzer = ProtobufAnalyzer(backend=backend)
+        buf = analyzer.tokenize_buffer(src)
+        elapsed = best_of(3, lambda: analyzer.tokenize_buffer(src))
+        assert elapsed < 2e-5 * len(src) + 0.5, elapsed
+        print('binary: %s, %d KB of random bytes, %d tokens, %d lexical '
+              'errors, %.1f ms' % (backend, len(src) // 1024, len(buf),
+                                   len(buf.diagnostics), elapsed * 1e3))
+
+
+@benchmark
+def names():
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufGrammar
+
+    grammar = ProtobufGrammar(backend='scanner')
+    sources = [synthetic(1, 6).replace('Model0', 'Model%d' % i)
+               for i in range(5000)]
+
+    def corpus_size(names):
+        analyzer = ProtobufAnalyzer(grammar=grammar, lean=True, names=names)
+        trees = [analyzer.parse_string(src) for src in sources]
+        return reachable_size([trees, analyzer.names])
+
+    plain = corpus_size(False)
+    interned = corpus_size(None)
+    print('names: %d files, %.1f MB without interning, %.1f MB with a '
+          'shared name table (%.0f%% less)' %
+          (len(sources), plain / 1048576.0, interned / 1048576.0,
+           100.0 * (plain - interned) / plain))
+
+
+@benchmark
+def structure():
+    from plyxproto.parser import ProtobufAnalyzer
+
+    analyzer = ProtobufAnalyzer(lean=True, backend='scanner')
+    src = synthetic(20, 10)
+    for spans in (True, False):
+        elapsed = best_of(5, lambda: analyzer.parse_string(src, spans=spans))
+        size = retained_memory(lambda: analyzer.parse_string(src, spans=spans))
+        print('structure: spans=%-5s %.1f ms, %.0f KB retained' %
+              (spans, elapsed * 1e3, size / 1024.0))
+
+
+@benchmark
+def recovery():
+    from plyxproto.parser import ProtobufAnalyzer
+
+    analyzer = ProtobufAnalyzer(lean=True, backend='scanner')
+    for n in (100, 1000, 10000):
+        clean = ''.join('message M%d {\n  required string a = 1;\n'
+                        '  required string b = 2;\n}\n' % i
+                        for i in range(n))
+        broken = clean.replace('b = 2', 'b = = 2')
+        tree = analyzer.parse_string(broken, recover=True)
+        assert len(tree.body) == n and len(tree.errors) == n
+        times = [best_of(3, lambda: analyzer.parse_string(src, recover=True))
+                 for src in (clean, broken)]
+        print('recovery: %5d messages, %.1f us per message clean, %.1f us '
+              'with one error each' % (n, times[0] * 1e6 / n,
+                                       times[1] * 1e6 / n))
+
+
+class ReductionCounter(object):
+    '''A yacc debug logger that only counts the reductions.'''
+
+    def __init__(self):
+        self.reductions = 0
+
+    def info(self, msg, *args, **kwargs):
+        if msg.startswith('Action : Reduce'):
+            self.reductions += 1
+
+    debug = warning = error = critical = info
+
+
+@benchmark
+def engine():
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufGrammar
+
+    src = synthetic(20, 20)
+    counter = ReductionCounter()
+    ProtobufAnalyzer(engine='ply').parse_string(src, debug=counter)
+    analyzers = [ProtobufAnalyzer(grammar=ProtobufGrammar(
+        backend='scanner', engine=name), lean=True)
+        for name in ('ply', 'generated')]
+    # Pre-lexed, without the collector and taking turns, to time the
+    # parsers alone.
+    tokens = analyzers[0].tokenize_buffer(src)
+    gc.disable()
+    try:
+        for spans in (True, False):
+            times = [None, None]
+            for _ in range(20):
+                for i, a in enumerate(analyzers):
+                    elapsed = best_of(1, lambda: a.parse_tokens(
+                        tokens, spans=spans))
+                    times[i] = min(times[i] or elapsed, elapsed)
+            print('engine: spans=%-5s %d reductions, ply %.1f ms (%.0f k/s), '
+                  'generated %.1f ms (%.0f k/s)' %
+                  (spans, counter.reductions, times[0] * 1e3,
+                   counter.reductions / times[0] / 1e3, times[1] * 1e3,
+                   counter.reductions / times[1] / 1e3))
+    finally:
+        gc.enable()
+
+
+@benchmark
+def unitrules():
+    import ply.yacc as yacc
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufParser
+
+    # The same tables with the pass-through rules reduced as usual.
+    eliminate = yacc.LRGeneratedTable.eliminate_unit_rules
+    yacc.LRGeneratedTable.eliminate_unit_rules = lambda self: None
+    try:
+        plain = yacc.yacc(module=ProtobufParser(), start='goal', debug=0,
+                          write_tables=0, tabmodule='_unitrules_parsetab',
+                          errorlog=yacc.NullLogger())
+    finally:
+        yacc.LRGeneratedTable.eliminate_unit_rules = eliminate
+    analyzers = [ProtobufAnalyzer(engine='ply', lean=True) for _ in range(2)]
+    parser = analyzers[0].session().parser
+    parser.action, parser.goto = plain.action, plain.goto
+
+    src = synthetic(20, 20)
+    tokens = analyzers[0].tokenize_buffer(src)
+    assert (canonical(analyzers[0].parse_string(src)) ==
+            canonical(analyzers[1].parse_string(src)))
+    counts = []
+    for a in analyzers:
+        counter = ReductionCounter()
+        a.parse_string(src, debug=counter)
+        counts.append(counter.reductions)
+    gc.disable()
+    try:
+        times = [None, None]
+        for _ in range(20):
+            for i, a in enumerate(analyzers):
+                elapsed = best_of(1, lambda: a.parse_tokens(tokens))
+                times[i] = min(times[i] or elapsed, elapsed)
+    finally:
+        gc.enable()
+    ntokens = len(tokens)
+    print('unitrules: %d tokens, %d reductions (%.2f per token) %.1f ms '
+          'before, %d (%.2f per token) %.1f ms after' %
+          (ntokens, counts[0], float(counts[0]) / ntokens, times[0] * 1e3,
+           counts[1], float(counts[1]) / ntokens, times[1] * 1e3))
+
+
+class DefaultedCounter(ReductionCounter):
+    '''Also counts the reductions made in defaulted states.'''
+
+    def __init__(self):
+        ReductionCounter.__init__(self)
+        self.defaulted = 0
+
+    def info(self, msg, *args, **kwargs):
+        ReductionCounter.info(self, msg)
+        if msg.startswith('Defaulted state'):
+            self.defaulted += 1
+
+    debug = warning = error = critical = info
+
+
+@benchmark
+def defaulted():
+    from plyxproto.parser import ProtobufAnalyzer
+
+    sources = corpus()
+    counter = DefaultedCounter()
+    analyzer = ProtobufAnalyzer(engine='ply')
+    for src in sources:
+        analyzer.parse_string(src, debug=counter)
+    states = analyzer.session().parser.defaulted_states
+    print('defaulted: %d of %d states, %d of %d reductions without an '
+          'action lookup' % (len(states), len(analyzer.grammar.table.lr_action),
+                             counter.defaulted, counter.reductions))
+
+    def parse_all(a):
+        for src in sources:
+            a.parse_string(src)
+
+    for engine in ('ply', 'generated'):
+        analyzers = [ProtobufAnalyzer(engine=engine, lean=True)
+                     for _ in range(2)]
+        analyzers[0].session().parser.disable_defaulted_states()
+        for src in sources:
+            assert (canonical(analyzers[0].parse_string(src)) ==
+                    canonical(analyzers[1].parse_string(src)))
+        gc.disable()
+        try:
+            times = [None, None]
+            for _ in range(20):
+                for i, a in enumerate(analyzers):
+                    elapsed = best_of(1, lambda: parse_all(a))
+                    times[i] = min(times[i] or elapsed, elapsed)
+        finally:
+            gc.enable()
+        print('defaulted: engine=%-9s corpus %.2f ms without, %.2f ms with '
+              'defaulted states' % (engine, times[0] * 1e3, times[1] * 1e3))
+
+
+def canonical(node):
+    from plyxproto.helpers import Base, _slots
+    if isinstance(node, list):
+        return [canonical(n) for n in node]
+    if isinstance(node, Base):
+        return (type(node).__name__, node.lexspan, node.linespan,
+                [canonical(getattr(node, k, None)) for k in _slots(type(node))
+                 if k not in ('parent', 'p', 'lexspan', 'linespan', 'lines')])
+    return node
+
+
+EDITS = ['', ' ', '\n', ';', '}', '{', 'x', '/*', '*/', '//', '<', '>', '"',
+         '#', ' = ', 'required string w = 3;\n',
+         'message Q {\n  required string z = 9;\n}\n']
+
+
+@benchmark
+def incremental():
+    import random
+    from plyxproto.incremental import reparse
+    from plyxproto.parser import ParsingError, ProtobufAnalyzer, PythonError
+
+    analyzer = ProtobufAnalyzer(lean=True)
+    full_parses = [0]
+    parse_string = analyzer.parse_string
+
+    def counting_parse(*args, **kwargs):
+        full_parses[0] += 1
+        return parse_string(*args, **kwargs)
+
+    rng = random.Random(1)
+    code = synthetic(6, 4)
+    tree = analyzer.parse_string(code)
+    edits = 2000
+    analyzer.parse_string = counting_parse
+    for _ in range(edits):
+        start = rng.randint(0, len(code))
+        end = min(len(code), start + rng.choice((0, 0, 1, 3, 20)))
+        text = rng.choice(EDITS)
+        new_code = code[:start] + text + code[end:]
+        try:
+            expected = canonical(parse_string(new_code))
+        except (ParsingError, PythonError) as e:
+            expected = (str(e), getattr(e, 'error_range', None),
+                        getattr(e, 'diagnostics', None))
+        try:
+            new_code, new_tree = reparse(analyzer, tree, code, start, end,
+                                         text)
+        except (ParsingError, PythonError) as e:
+            assert expected == (str(e), getattr(e, 'error_range', None),
+                                getattr(e, 'diagnostics', None)), \
+                (code, start, end, text)
+            continue
+        assert canonical(new_tree) == expected, (code, start, end, text)
+        assert new_tree.diagnostics == parse_string(new_code).diagnostics
+        code, tree = new_code, new_tree
+    analyzer.parse_string = parse_string
+    print('incremental: %d random edits agree with full parses, %d needed '
+          'one' % (edits, full_parses[0]))
+
+    code = synthetic(1000, 6)
+    pos = code.index('string field2', len(code) // 2) + len('string ')
+
+    def edit():
+        tree = analyzer.parse_string(code)
+        start = time.time()
+        reparse(analyzer, tree, code, pos, pos + 2, 'renamed')
+        return time.time() - start
+
+    full = best_of(3, lambda: analyzer.parse_string(code))
+    edited = min(edit() for _ in range(3))
+    print('incremental: renaming a field in a %d KB file, %.1f ms full '
+          'parse, %.1f ms reparse' % (len(code) // 1024, full * 1e3,
+                                      edited * 1e3))
+
+
+@benchmark
+def parallel():
+    import multiprocessing
+    from plyxproto.batch import parse_parallel, top_level_cuts
+    from plyxproto.parser import ProtobufAnalyzer
+
+    code = synthetic(1000, 6)
+    serial = ProtobufAnalyzer(lean=True).parse_string(code)
+    assert canonical(parse_parallel(code, jobs=4)) == canonical(serial)
+    prescan = best_of(3, lambda: top_level_cuts(code, 1 << 16))
+    print('parallel: %d KB, %d CPUs, pre-scan %.1f ms, trees identical to '
+          'a serial parse' % (len(code) // 1024, multiprocessing.cpu_count(),
+                              prescan * 1e3))
+    for jobs in (1, 2, 4):
+        elapsed = best_of(1, lambda: parse_parallel(code, jobs=jobs))
+        print('parallel: jobs=%d %.2f s' % (jobs, elapsed))
+
+
+@benchmark
+def cache():
+    from plyxproto.cache import DiskCache
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufGrammar
+
+    grammar = ProtobufGrammar()
+    tmpdir = tempfile.mkdtemp(prefix='plyxproto-bench-')
+    try:
+        paths = []
+        for i in range(2000):
+            path = os.path.join(tmpdir, 'm%d.xproto' % i)
+            with open(path, 'w') as f:
+                f.write(synthetic(2, 8).replace('Model', 'M%d_' % i))
+            paths.append(path)
+
+        def build(cache):
+            analyzer = ProtobufAnalyzer(grammar=grammar, lean=True,
+                                        cache=cache)
+            start = time.time()
+            trees = [analyzer.parse_file(path) for path in paths]
+            return time.time() - start, trees
+
+        uncached, expected = build(None)
+        store = os.path.join(tmpdir, 'cache')
+        cold, _ = build(DiskCache(store))
+        warm_cache = DiskCache(store)
+        warm, trees = build(warm_cache)
+        assert [canonical(t) for t in trees] == \
+            [canonical(t) for t in expected]
+        stats = warm_cache.stats()
+        print('cache: %d files, %.2f s without a cache, %.2f s cold, %.2f s '
+              'warm (%d hits, %.1f MB read)' %
+              (len(paths), uncached, cold, warm, stats.hits,
+               stats.bytes_read / 1048576.0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@benchmark
+def memcache():
+    import random
+
+    from plyxproto.cache import MemoryCache
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufGrammar
+
+    grammar = ProtobufGrammar()
+    tmpdir = tempfile.mkdtemp(prefix='plyxproto-bench-')
+    try:
+        paths = []
+        for i in range(200):
+            path = os.path.join(tmpdir, 'm%d.xproto' % i)
+            with open(path, 'w') as f:
+                f.write(synthetic(2, 8).replace('Model', 'M%d_' % i))
+            paths.append(path)
+        # A service asking about random models, 5000 times.
+        rng = random.Random(7)
+        requests = [rng.choice(paths) for _ in range(5000)]
+
+        def serve(cache):
+            analyzer = ProtobufAnalyzer(grammar=grammar, cache=cache)
+            start = time.time()
+            for path in requests:
+                analyzer.parse_file(path)
+            return (time.time() - start) * 1000.0 / len(requests)
+
+        uncached = serve(None)
+        memory = MemoryCache()
+        cached = serve(memory)
+        stats = memory.stats()
+        print('memcache: %.2f ms a request without a cache, %.2f ms with '
+              '(%d hits, %d misses, %d nodes kept)' %
+              (uncached, cached, stats.hits, stats.misses, stats.nodes))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    for b in benchmarks:
+        if not selected or b.__name__ in selected:
+            b()
@@ -0,0 +1,489 @@
+from __future__ import print_function
+
+# Correctness checks for plyxproto. Run all of them with `python check.py`,
+# or pick some by name, e.g. `python check.py python_bodies`. A failed check
+# raises AssertionError.
+
+import sys
+
+checks = []
+
+
+def check(f):
+    checks.append(f)
+    return f
+
+
+# Fragments random edits insert: delimiters, keywords and whole statements,
+# valid and broken.
+PIECES = ['', ' ', '\n', ';', '{', '}', '<', '>', '(', ')', '[', ']', '"',
+          '/*', '*/', '//', '@', 'x', '1', ' = ', '::', '->', 'message',
+          'required ', 'enum E {', 'extend', 'option x = 1;', 'import "a";',
+          'policy p <', 'policy p < a | b >', 'map m <lambda x: x>',
+          'reduce r <lambda x y: x>', 'message Q {\n  required string z = 9;\n}\n']
+
+
+_sources = []
+
+
+def sources():
+    if not _sources:
+        from bench import SAMPLE, synthetic
+        _sources.extend([SAMPLE, synthetic(3, 5)])
+    return _sources
+
+
+def edited(rng, code):
+    '''code with one to three random fragments pasted over random spots.'''
+    for _ in range(rng.randrange(1, 4)):
+        start = rng.randrange(len(code) + 1)
+        end = min(len(code), start + rng.randrange(8))
+        code = code[:start] + rng.choice(PIECES) + code[end:]
+    return code
+
+
+def outcome(analyzer, code, **kwargs):
+    '''
+    What parsing code gives, in a form that compares by value: the tree
+    (see bench.canonical) with its errors and diagnostics, or the error.
+    '''
+    from bench import canonical
+    from plyxproto.parser import ParsingError, PythonError
+
+    try:
+        tree = analyzer.parse_string(code, **kwargs)
+    except ParsingError as e:
+        return ('error', e.args, e.error_range,
+                [(x.args, x.error_range) for x in e.errors or ()],
+                e.diagnostics)
+    except PythonError as e:
+        return ('python', e.args)
+    errors = [(e.args, e.error_range) for e in tree.errors]
+    return ('tree', canonical(tree.body), errors, tree.diagnostics)
+
+
+def agree(analyzers, edits, seed, modes=({},)):
+    '''
+    All analyzers give the same outcome for the sources and for edits
+    randomly edited ones, with each of the parse options in modes.
+    '''
+    import random
+
+    rng = random.Random(seed)
+    codes = list(sources())
+    codes.extend(edited(rng, rng.choice(sources())) for _ in range(edits))
+    for code in codes:
+        for kwargs in modes:
+            expected = outcome(analyzers[0], code, **kwargs)
+            for analyzer in analyzers[1:]:
+                assert outcome(analyzer, code, **kwargs) == expected, \
+                    (code, kwargs)
+
+
+def lexemes(lexer, data, lineno=1):
+    '''Every token lexer makes of data, and where it stops.'''
+    lexer = lexer.clone()
+    lexer.lineno = lineno
+    lexer.diagnostics = []
+    lexer.input(data)
+    tokens = [(t.type, t.value, t.lineno, t.lexpos) for t in lexer]
+    return tokens, lexer.lineno, lexer.lexpos, lexer.diagnostics
+
+
+def random_text(rng, alphabet, count):
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+            for _ in range(count)]
+
+
+IMPORT_SCRIPT = '''
+import plyxproto.parser as plyproto
+assert plyproto.ProtobufParser._fol is None, 'policy parser built at import'
+plyproto.ProtobufAnalyzer().parse_string('policy p < a >')
+assert plyproto.ProtobufParser._fol is not None
+'''
+
+
+@check
+def lazy_policy_parser():
+    import os
+    import subprocess
+
+    # Importing the parser does not build the policy sub-parser; the first
+    # policy does.
+    subprocess.check_call([sys.executable, '-c', IMPORT_SCRIPT],
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+@check
+def spans():
+    from ply.yacc import YaccProduction
+    from plyxproto.helpers import LexHelper
+    from plyxproto.parser import ProtobufAnalyzer
+
+    # The one-pass span computation agrees with the two old methods on every
+    # reduction.
+    productions = []
+    set_parse_object = LexHelper.set_parse_object
+
+    def record(self, dst, p):
+        productions.append(YaccProduction(list(p.slice)))
+        set_parse_object(self, dst, p)
+
+    LexHelper.set_parse_object = record
+    try:
+        analyzer = ProtobufAnalyzer(lean=True)
+        for code in sources():
+            analyzer.parse_string(code)
+    finally:
+        LexHelper.set_parse_object = set_parse_object
+    assert productions
+    lh = LexHelper()
+    for p in productions:
+        assert lh.get_spans(p) == \
+            (lh.get_max_linespan(p), lh.get_max_lexspan(p)), p.slice
+
+
+def lazy_rule(pattern, keep):
+    '''A rule matching a whole delimited token with one lazy regex.'''
+    def rule(self, t):
+        t.lexer.lineno += t.value.count('\n')
+        if keep:
+            return t
+    rule.__doc__ = pattern
+    return rule
+
+
+@check
+def delimited_tokens(inputs=3000):
+    import random
+    import ply.lex as lex
+    from plyxproto.logicparser import FOLLexer
+    from plyxproto.parser import ProtobufLexer
+
+    # Delimited tokens are found with str.find. They come out as they did
+    # from the lazy regexes this replaced. (The reference lexers are made
+    # with type(): PLY rejects a rule name assigned twice in one file.)
+    comment = lazy_rule(r'/\*(.|\n)*?\*/', False)
+    LazyProtobufLexer = type('LazyProtobufLexer', (ProtobufLexer,), {
+        't_POLICYBODY': lazy_rule(r'< (.|\n)*? [^-]>', True),
+        't_BLOCK_COMMENT': comment})
+    LazyFOLLexer = type('LazyFOLLexer', (FOLLexer,), {
+        't_ESCAPE': lazy_rule(r'{{ (.|\n)*? }}', True),
+        't_BLOCK_COMMENT': comment})
+
+    alphabet = ['<', '>', '-', '/', '*', '{', '}', '\n', 'a', ' ', '"', '=',
+                ';', '->', '/*', '*/', '{{', '}}', '<<', 'x.y']
+    rng = random.Random(3)
+    texts = sources() + random_text(rng, alphabet, inputs)
+    for module, lazy in [(ProtobufLexer(), LazyProtobufLexer()),
+                         (FOLLexer(), LazyFOLLexer())]:
+        lexer = lex.lex(module=module)
+        reference = lex.lex(module=lazy)
+        for text in texts:
+            assert lexemes(lexer, text) == lexemes(reference, text), text
+
+
+@check
+def scanner(inputs=20000):
+    import random
+    from plyxproto.parser import ProtobufGrammar
+
+    # The hand-written scanner makes the same tokens, line numbers and
+    # diagnostics as the PLY lexer.
+    alphabet = ['<', '>', '-', '/', '*', '{', '}', '\n', '\r', '\r\n', 'a',
+                ' ', '\t', '"', '\\', '=', ';', '->', '/*', '*/', '//', '<<',
+                'x.y', '+', '12', '3.4', '.', ':', '::', '#', '`', 'message',
+                'max', '$a', '_', '[', ']', '(', ')', ',', '?', '@', '%', '!',
+                '\x01', '"ab\\"c"']
+    rng = random.Random(4)
+    ply = ProtobufGrammar(backend='ply').lexer
+    hand = ProtobufGrammar(backend='scanner').lexer
+    for text in sources() + random_text(rng, alphabet, inputs):
+        lineno = rng.randint(1, 5)
+        assert lexemes(ply, text, lineno) == lexemes(hand, text, lineno), text
+
+
+@check
+def python_bodies():
+    from plyxproto.parser import ParsingError, ProtobufAnalyzer
+
+    analyzer = ProtobufAnalyzer()
+    # The lambda of a reduce or map definition that is not Python is a
+    # syntax error at the offending character, not silent PLY recovery.
+    code = ('message A { required string a = 1; }\n'
+            'reduce r1 <lambda x y: x>\n'
+            'message B { required string b = 1; }\n')
+    for recover in (False, True):
+        for source in (code, 'reduce r1 <lambda x y: x>\n'):
+            try:
+                tree = analyzer.parse_string(source, recover=recover)
+            except ParsingError as e:
+                assert not recover
+                error = e
+            else:
+                assert recover
+                assert len(tree.errors) == 1
+                error = tree.errors[0]
+            assert error.args[0] == 'Python syntax error in reduce r1'
+            assert error.error_range[1] == source.index('y:') + 1
+    # A recovering parse keeps every statement, the reduce without a body.
+    tree = analyzer.parse_string(code, recover=True)
+    names = [type(n).__name__ for n in tree.body]
+    assert names == ['MessageDefinition', 'ReduceDefinition',
+                     'MessageDefinition'], names
+    assert tree.body[1].body is None
+
+    code = 'message A {}\nmap m <lambda x: (>\n'
+    try:
+        analyzer.parse_string(code)
+    except ParsingError as e:
+        assert e.args[0] == 'Python syntax error in map m'
+        assert e.error_range[0] == 2
+    else:
+        assert False, 'no error'
+    tree = analyzer.parse_string(code, recover=True)
+    assert [e.args[0] for e in tree.errors] == ['Python syntax error in map m']
+
+
+@check
+def policy_lines():
+    from plyxproto.parser import ParsingError, ProtobufAnalyzer
+
+    # An error in a policy body is reported on the line it is on, whether
+    # the body starts on that line or above it.
+    analyzer = ProtobufAnalyzer()
+    for code, line in [('message A {}\npolicy p < a & >\n', 2),
+                       ('message A {}\n\npolicy p <\n a |\n & | b >\n', 5),
+                       ('policy p < ( >', 1)]:
+        try:
+            analyzer.parse_string(code)
+        except ParsingError as e:
+            assert e.error_range[0] == line, (code, e.error_range)
+        else:
+            assert False, 'no error'
+        tree = analyzer.parse_string(code, recover=True)
+        assert tree.errors[0].error_range[0] == line, code
+
+
+@check
+def first_error(edits=1000):
+    import random
+    from plyxproto.parser import ProtobufAnalyzer
+
+    # Without recover, a parse gives the tree of a recovering parse that
+    # found no errors, or raises the first error it found.
+    analyzer = ProtobufAnalyzer()
+    rng = random.Random(1)
+    for _ in range(edits):
+        code = edited(rng, rng.choice(sources()))
+        strict = outcome(analyzer, code)
+        recovered = outcome(analyzer, code, recover=True)
+        if recovered[0] == 'tree' and not recovered[2]:
+            assert strict == recovered, code
+        elif recovered[0] == 'tree':
+            assert strict[0] == 'error', code
+            assert (strict[1], strict[2]) == recovered[2][0], code
+        elif recovered[0] == 'error':
+            assert strict[0] == 'error', code
+            assert (strict[1], strict[2]) == recovered[3][0], code
+        else:
+            # A PythonError stops a recovering parse too, unless a syntax
+            # error came first.
+            assert strict == recovered or strict[0] == 'error', code
+
+
+@check
+def no_silent_recovery():
+    from plyxproto.parser import ParsingError, ProtobufAnalyzer, ProtobufParser
+
+    # A SyntaxError out of a rule action starts PLY's error recovery without
+    # p_error. The error productions must not swallow it when not recovering.
+    def raising(self, p, kind):
+        raise SyntaxError('invalid syntax')
+
+    lambda_body = ProtobufParser.lambda_body
+    ProtobufParser.lambda_body = raising
+    try:
+        code = ('message A { required string a = 1; }\n'
+                'reduce r <lambda x: x>\n'
+                'message B { required string b = 1; }\n')
+        try:
+            tree = ProtobufAnalyzer().parse_string(code)
+        except ParsingError:
+            pass
+        else:
+            assert False, 'parsed to %r' % (tree.body,)
+    finally:
+        ProtobufParser.lambda_body = lambda_body
+
+
+@check
+def equal_parses():
+    from plyxproto.parser import ProtobufAnalyzer
+    from bench import SAMPLE
+
+    # Trees compare by what they hold, not by how they were parsed: two
+    # parses of one text are equal, whatever their line tables and parser
+    # references.
+    changed = SAMPLE.replace('required', 'optional', 1)
+    for lean in (False, True):
+        analyzer = ProtobufAnalyzer(lean=lean)
+        for spans in (False, True):
+            tree = analyzer.parse_string(SAMPLE, spans=spans)
+            assert tree == analyzer.parse_string(SAMPLE, spans=spans)
+            assert tree != analyzer.parse_string(changed, spans=spans)
+
+
+@check
+def incremental(edits=600):
+    import random
+    from bench import canonical
+    from plyxproto.incremental import reparse
+    from plyxproto.parser import ParsingError, ProtobufAnalyzer, PythonError
+    from plyxproto.source import LineTable
+
+    # An incremental reparse gives what a full parse gives, line table
+    # included. A tree it fails on or parses anew is left as it was.
+    analyzer = ProtobufAnalyzer()
+    rng = random.Random(2)
+    code = rng.choice(sources())
+    tree = analyzer.parse_string(code)
+    for _ in range(edits):
+        start = rng.randrange(len(code) + 1)
+        end = min(len(code), start + rng.choice((0, 0, 1, 3, 20)))
+        text = rng.choice(PIECES)
+        new_code = code[:start] + text + code[end:]
+        expected = outcome(analyzer, new_code)
+        statements = list(tree.body)
+        try:
+            new_code, new_tree = reparse(analyzer, tree, code, start, end,
+                                         text)
+        except (ParsingError, PythonError):
+            failed = outcome(analyzer, new_code)
+            assert failed == expected and failed[0] != 'tree'
+            new_tree = None
+        else:
+            assert ('tree', canonical(new_tree.body), [],
+                    new_tree.diagnostics) == expected
+            assert new_tree == analyzer.parse_string(new_code)
+            lines = LineTable(new_code, 1, 1)
+            assert (new_tree.lines.starts, new_tree.lines.lineno,
+                    new_tree.lines.offset) == \
+                (lines.starts, lines.lineno, lines.offset)
+        if new_tree is None or not set(map(id, statements)) & \
+                set(map(id, new_tree.body)):
+            assert tree == analyzer.parse_string(code), (code, start, end)
+        if new_tree is None or rng.random() < 0.1:
+            # Start over now and then, so edits do not pile up into noise.
+            code = rng.choice(sources())
+            tree = analyzer.parse_string(code)
+        else:
+            code, tree = new_code, new_tree
+
+
+@check
+def engines(edits=500):
+    from plyxproto.parser import ProtobufAnalyzer
+
+    # The generated parser builds what PLY's LRParser builds, errors and
+    # recovery included.
+    agree([ProtobufAnalyzer(engine=engine, lean=True)
+           for engine in ('ply', 'generated')], edits, 5,
+          [dict(recover=recover, spans=spans)
+           for recover in (False, True) for spans in (False, True)])
+
+
+@check
+def unit_rules(edits=500):
+    import ply.yacc as yacc
+    from plyxproto.parser import ProtobufAnalyzer, ProtobufParser
+
+    # Tables with the pass-through unit rules taken out parse as the tables
+    # that reduce them.
+    eliminate = yacc.LRGeneratedTable.eliminate_unit_rules
+    yacc.LRGeneratedTable.eliminate_unit_rules = lambda self: None
+    try:
+        plain = yacc.yacc(module=ProtobufParser(), start='goal', debug=0,
+                          write_tables=0, tabmodule='_unitrules_parsetab',
+                          errorlog=yacc.NullLogger())
+    finally:
+        yacc.LRGeneratedTable.eliminate_unit_rules = eliminate
+    analyzers = [ProtobufAnalyzer(engine='ply', lean=True) for _ in range(2)]
+    parser = analyzers[0].session().parser
+    assert plain.goto != parser.goto
+    parser.action, parser.goto = plain.action, plain.goto
+    parser.set_defaulted_states()
+    agree(analyzers, edits, 6,
+          [dict(recover=recover, spans=spans)
+           for recover in (False, True) for spans in (False, True)])
+
+
+@check
+def defaulted_states(edits=500):
+    from plyxproto.parser import ProtobufAnalyzer
+
+    # Reducing in defaulted states without reading ahead changes no tree
+    # and no error.
+    for engine in ('ply', 'generated'):
+        analyzers = [ProtobufAnalyzer(engine=engine, lean=True)
+                     for _ in range(2)]
+        analyzers[0].session().parser.disable_defaulted_states()
+        agree(analyzers, edits, 7,
+              [dict(recover=recover) for recover in (False, True)])
+
+
+@check
+def backends():
+    from plyxproto.parser import ProtobufAnalyzer
+
+    # Lexer backends, parser engines and lean mode all give the same trees.
+    agree([ProtobufAnalyzer(backend=backend, engine=engine, lean=lean)
+           for backend in ('ply', 'scanner')
+           for engine in ('ply', 'generated')
+           for lean in (False, True)], 200, 8,
+          [dict(recover=recover, spans=spans)
+           for recover in (False, True) for spans in (False, True)])
+
+
+@check
+def cache_keys():
+    import shutil
+    import tempfile
+    from plyxproto.cache import DiskCache, MemoryCache
+    from plyxproto.parser import ProtobufAnalyzer
+    from bench import SAMPLE
+
+    # Analyzers that build different trees never share cache entries, and
+    # a hit is the tree a parse without the cache gives.
+    path = tempfile.mkdtemp(prefix='plyxproto-check-')
+    try:
+        for cache in (DiskCache(path), MemoryCache()):
+            keys = set()
+            for backend in ('ply', 'scanner'):
+                for engine in ('ply', 'generated'):
+                    for lean in (False, True):
+                        analyzer = ProtobufAnalyzer(
+                            backend=backend, engine=engine, lean=lean,
+                            cache=cache)
+                        for spans in (False, True):
+                            keys.add(cache.key(SAMPLE, *analyzer._options(
+                                1, '+', spans, False)))
+                            expected = outcome(analyzer, SAMPLE, spans=spans)
+                            analyzer.cache = None
+                            assert outcome(analyzer, SAMPLE,
+                                           spans=spans) == expected
+                            analyzer.cache = cache
+                            assert outcome(analyzer, SAMPLE,
+                                           spans=spans) == expected
+            assert len(keys) == 16
+            assert cache.stats().hits == 16
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    for c in checks:
+        if not selected or c.__name__ in selected:
+            c()
+            print('%s: ok' % c.__name__)
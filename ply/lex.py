@@ -132,6 +132,7 @@ class Lexer:
         self.lexlen = 0               # Length of the input text
         self.lexerrorf = None         # Error rule (if any)
         self.lextokens = None         # List of valid tokens
+        self.lextokens_all = None     # Valid tokens plus literals
         self.lexignore = ""           # Ignored characters
         self.lexliterals = ""         # Literal characters that can be passed through
         self.lexmodule = None         # Module
@@ -226,8 +227,11 @@ class Lexer:
             raise ImportError("Inconsistent PLY version")
 
         self.lextokens      = lextab._lextokens
+        self.lextokens_all  = dict(self.lextokens)
         self.lexreflags     = lextab._lexreflags
         self.lexliterals    = lextab._lexliterals
+        for c in self.lexliterals:
+            self.lextokens_all[c] = 1
         self.lexstateinfo   = lextab._lexstateinfo
         self.lexstateignore = lextab._lexstateignore
         self.lexstatere     = { }
@@ -355,7 +359,7 @@ class Lexer:
 
                 # Verify type of the token.  If not in the token map, raise an error
                 if not self.lexoptimize:
-                    if not newtok.type in self.lextokens:
+                    if not newtok.type in self.lextokens_all:
                         raise LexError("%s:%d: Rule '%s' returned an unknown token type '%s'" % (
                             func_code(func).co_filename, func_code(func).co_firstlineno,
                             func.__name__, newtok.type),lexdata[lexpos:])
@@ -375,7 +379,9 @@ class Lexer:
                 # No match. Call t_error() if defined.
                 if self.lexerrorf:
                     tok = LexToken()
-                    tok.value = self.lexdata[lexpos:]
+                    # Only the offending character: copying the rest of
+                    # the input would cost O(n) per error.
+                    tok.value = lexdata[lexpos]
                     tok.lineno = self.lineno
                     tok.type = "error"
                     tok.lexer = self
@@ -926,6 +932,11 @@ def lex(module=None,object=None,debug=0,optimize=0,lextab="lextab",reflags=0,now
     else:
         lexobj.lexliterals = linfo.literals
 
+    # Rule functions may also return literal tokens
+    lexobj.lextokens_all = dict(lexobj.lextokens)
+    for c in lexobj.lexliterals:
+        lexobj.lextokens_all[c] = 1
+
     # Get the stateinfo dictionary
     stateinfo = linfo.stateinfo
 
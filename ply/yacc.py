@@ -290,10 +290,35 @@ class LRParser:
         self.action      = lrtab.lr_action
         self.goto        = lrtab.lr_goto
         self.errorfunc   = errorf
+        self.set_defaulted_states()
 
     def errok(self):
         self.errorok     = 1
 
+    # Defaulted states are states whose every action is a reduction by the
+    # same rule.  The parser reduces in them without looking at the lookahead,
+    # and so without reading a token if it has none yet.  A token that is not
+    # valid there is then reported by the state reached after the reduction.
+    # That is only the same parse if the action does not fail: one that raises
+    # (or records) an error would now do so before the bad token is seen,
+    # and its error would be reported instead of the token's.  Such rules
+    # must be marked with needs_lookahead(); states reducing by them are not
+    # defaulted.  Nothing can detect an unmarked one, so the grammar has to
+    # keep to this.  disable_defaulted_states() turns defaulting off
+    # altogether, to compare the two.
+
+    def set_defaulted_states(self):
+        self.defaulted_states = { }
+        for state, actions in self.action.items():
+            rules = set(actions.values())
+            if len(rules) == 1:
+                rule = rules.pop()
+                if rule < 0 and not getattr(self.productions[-rule].callable,'needs_lookahead',False):
+                    self.defaulted_states[state] = rule
+
+    def disable_defaulted_states(self):
+        self.defaulted_states = { }
+
     def restart(self):
         del self.statestack[:]
         del self.symstack[:]
@@ -333,6 +358,7 @@ class LRParser:
         actions = self.action            # Local reference to action table (to avoid lookup on self.)
         goto    = self.goto              # Local reference to goto table (to avoid lookup on self.)
         prod    = self.productions       # Local reference to production list (to avoid lookup on self.)
+        defaulted_states = self.defaulted_states  # Local reference to defaulted states
         pslice  = YaccProduction(None)   # Production object passed to grammar rules
         errorcount = 0                   # Used during error recovery 
 
@@ -389,23 +415,29 @@ class LRParser:
             debug.debug('State  : %s', state)
             # --! DEBUG
 
-            if not lookahead:
-                if not lookaheadstack:
-                    lookahead = get_token()     # Get the next token
-                else:
-                    lookahead = lookaheadstack.pop()
+            if state not in defaulted_states:
                 if not lookahead:
-                    lookahead = YaccSymbol()
-                    lookahead.type = "$end"
+                    if not lookaheadstack:
+                        lookahead = get_token()     # Get the next token
+                    else:
+                        lookahead = lookaheadstack.pop()
+                    if not lookahead:
+                        lookahead = YaccSymbol()
+                        lookahead.type = "$end"
 
-            # --! DEBUG
-            debug.debug('Stack  : %s',
-                        ("%s . %s" % (" ".join([xx.type for xx in symstack][1:]), str(lookahead))).lstrip())
-            # --! DEBUG
+                # --! DEBUG
+                debug.debug('Stack  : %s',
+                            ("%s . %s" % (" ".join([xx.type for xx in symstack][1:]), str(lookahead))).lstrip())
+                # --! DEBUG
 
-            # Check the action table
-            ltype = lookahead.type
-            t = actions[state].get(ltype)
+                # Check the action table
+                ltype = lookahead.type
+                t = actions[state].get(ltype)
+            else:
+                t = defaulted_states[state]
+                # --! DEBUG
+                debug.debug('Defaulted state %s: Reduce using %d', state, -t)
+                # --! DEBUG
 
             if t is not None:
                 if t > 0:
@@ -478,7 +510,8 @@ class LRParser:
                             statestack.append(state)
                         except SyntaxError:
                             # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
+                            if lookahead:
+                                lookaheadstack.append(lookahead)
                             symstack.pop()
                             statestack.pop()
                             state = statestack[-1]
@@ -517,7 +550,8 @@ class LRParser:
                             statestack.append(state)
                         except SyntaxError:
                             # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
+                            if lookahead:
+                                lookaheadstack.append(lookahead)
                             symstack.pop()
                             statestack.pop()
                             state = statestack[-1]
@@ -653,6 +687,7 @@ class LRParser:
         actions = self.action            # Local reference to action table (to avoid lookup on self.)
         goto    = self.goto              # Local reference to goto table (to avoid lookup on self.)
         prod    = self.productions       # Local reference to production list (to avoid lookup on self.)
+        defaulted_states = self.defaulted_states  # Local reference to defaulted states
         pslice  = YaccProduction(None)   # Production object passed to grammar rules
         errorcount = 0                   # Used during error recovery 
 
@@ -700,18 +735,21 @@ class LRParser:
             # is already set, we just use that. Otherwise, we'll pull
             # the next token off of the lookaheadstack or from the lexer
 
-            if not lookahead:
-                if not lookaheadstack:
-                    lookahead = get_token()     # Get the next token
-                else:
-                    lookahead = lookaheadstack.pop()
+            if state not in defaulted_states:
                 if not lookahead:
-                    lookahead = YaccSymbol()
-                    lookahead.type = '$end'
-
-            # Check the action table
-            ltype = lookahead.type
-            t = actions[state].get(ltype)
+                    if not lookaheadstack:
+                        lookahead = get_token()     # Get the next token
+                    else:
+                        lookahead = lookaheadstack.pop()
+                    if not lookahead:
+                        lookahead = YaccSymbol()
+                        lookahead.type = '$end'
+
+                # Check the action table
+                ltype = lookahead.type
+                t = actions[state].get(ltype)
+            else:
+                t = defaulted_states[state]
 
             if t is not None:
                 if t > 0:
@@ -769,7 +807,8 @@ class LRParser:
                             statestack.append(state)
                         except SyntaxError:
                             # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
+                            if lookahead:
+                                lookaheadstack.append(lookahead)
                             symstack.pop()
                             statestack.pop()
                             state = statestack[-1]
@@ -805,7 +844,8 @@ class LRParser:
                             statestack.append(state)
                         except SyntaxError:
                             # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
+                            if lookahead:
+                                lookaheadstack.append(lookahead)
                             symstack.pop()
                             statestack.pop()
                             state = statestack[-1]
@@ -931,6 +971,7 @@ class LRParser:
         actions = self.action            # Local reference to action table (to avoid lookup on self.)
         goto    = self.goto              # Local reference to goto table (to avoid lookup on self.)
         prod    = self.productions       # Local reference to production list (to avoid lookup on self.)
+        defaulted_states = self.defaulted_states  # Local reference to defaulted states
         pslice  = YaccProduction(None)   # Production object passed to grammar rules
         errorcount = 0                   # Used during error recovery 
 
@@ -978,18 +1019,21 @@ class LRParser:
             # is already set, we just use that. Otherwise, we'll pull
             # the next token off of the lookaheadstack or from the lexer
 
-            if not lookahead:
-                if not lookaheadstack:
-                    lookahead = get_token()     # Get the next token
-                else:
-                    lookahead = lookaheadstack.pop()
+            if state not in defaulted_states:
                 if not lookahead:
-                    lookahead = YaccSymbol()
-                    lookahead.type = '$end'
-
-            # Check the action table
-            ltype = lookahead.type
-            t = actions[state].get(ltype)
+                    if not lookaheadstack:
+                        lookahead = get_token()     # Get the next token
+                    else:
+                        lookahead = lookaheadstack.pop()
+                    if not lookahead:
+                        lookahead = YaccSymbol()
+                        lookahead.type = '$end'
+
+                # Check the action table
+                ltype = lookahead.type
+                t = actions[state].get(ltype)
+            else:
+                t = defaulted_states[state]
 
             if t is not None:
                 if t > 0:
@@ -1036,7 +1080,8 @@ class LRParser:
                             statestack.append(state)
                         except SyntaxError:
                             # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
+                            if lookahead:
+                                lookaheadstack.append(lookahead)
                             symstack.pop()
                             statestack.pop()
                             state = statestack[-1]
@@ -1066,7 +1111,8 @@ class LRParser:
                             statestack.append(state)
                         except SyntaxError:
                             # If an error was set. Enter error recovery state
-                            lookaheadstack.append(lookahead)
+                            if lookahead:
+                                lookaheadstack.append(lookahead)
                             symstack.pop()
                             statestack.pop()
                             state = statestack[-1]
@@ -1210,6 +1256,7 @@ _is_identifier = re.compile(r'^[a-zA-Z0-9_-]+$')
 
 class Production(object):
     reduced = 0
+    passthrough = False
     def __init__(self,number,name,prod,precedence=('right',0),func=None,file='',line=0):
         self.name     = name
         self.prod     = tuple(prod)
@@ -1538,6 +1585,27 @@ class Grammar(object):
         self.Nonterminals[start].append(0)
         self.Start = start
 
+    # -----------------------------------------------------------------------------
+    # set_passthrough()
+    #
+    # Marks the productions of the given rule functions as pass-through: their
+    # action only forwards the value of the single symbol on the right.  Unit
+    # rules among them (A -> B with B a nonterminal) are left out of the parse
+    # by the table generator.  Returns the marked productions that are not unit
+    # rules, and so are parsed as usual.
+    # -----------------------------------------------------------------------------
+
+    def set_passthrough(self,funcnames):
+        others = []
+        for p in self.Productions[1:]:
+            if p.func not in funcnames:
+                continue
+            if p.len == 1 and p.prod[0] in self.Nonterminals:
+                p.passthrough = True
+            else:
+                others.append(p)
+        return others
+
     # -----------------------------------------------------------------------------
     # find_unreachable()
     #
@@ -2030,6 +2098,7 @@ class LRGeneratedTable(LRTable):
         self.grammar.compute_first()
         self.grammar.compute_follow()
         self.lr_parse_table()
+        self.eliminate_unit_rules()
 
     # Compute the LR(0) closure operation on I, where I is a set of LR(0) items.
 
@@ -2594,6 +2663,54 @@ class LRGeneratedTable(LRTable):
             goto[st] = st_goto
             st += 1
 
+    # -----------------------------------------------------------------------------
+    # eliminate_unit_rules()
+    #
+    # Removes the reductions by pass-through unit rules A -> B (see
+    # Grammar.set_passthrough()).  A state entered on B whose only action is to
+    # reduce by such a rule, whatever the lookahead, does nothing but replace B
+    # by A on the stack.  Every goto on B into it is sent where the goto on A
+    # from the same state leads instead, following chains of such rules to the
+    # end, and B stays on the stack with its value in place of A.  The states
+    # themselves are kept, but are no longer entered.
+    # -----------------------------------------------------------------------------
+
+    def eliminate_unit_rules(self):
+        Productions = self.grammar.Productions
+        log = self.log
+
+        unit = { }
+        for st, actions in self.lr_action.items():
+            if not actions or self.lr_goto.get(st):
+                continue
+            rules = set(actions.values())
+            if len(rules) != 1:
+                continue
+            r = rules.pop()
+            if r < 0 and Productions[-r].passthrough:
+                unit[st] = Productions[-r]
+
+        self.unit_states = len(unit)
+        if not unit:
+            return
+
+        log.info("")
+        log.info("Unit rules eliminated")
+        log.info("")
+        for st, gotos in self.lr_goto.items():
+            for n in list(gotos):
+                j = gotos[n]
+                seen = [ ]
+                while j in unit and j not in seen:
+                    seen.append(j)
+                    target = gotos.get(unit[j].name)
+                    if target is None:
+                        break
+                    j = target
+                if j != gotos[n]:
+                    log.info("    state %d: %-20s go to state %d (was %d)", st, n, j, gotos[n])
+                    gotos[n] = j
+
 
     # -----------------------------------------------------------------------------
     # write()
@@ -2868,6 +2985,8 @@ class ParserReflect(object):
             for f in self.pfuncs:
                 if f[3]:
                     sig.update(f[3].encode('latin-1'))
+            if self.passthrough:
+                sig.update(" ".join(self.passthrough).encode('latin-1'))
         except (TypeError,ValueError):
             pass
         return sig.digest()
@@ -3011,6 +3130,7 @@ class ParserReflect(object):
     # Get all p_functions from the grammar
     def get_pfunctions(self):
         p_functions = []
+        self.passthrough = []
         for name, item in self.pdict.items():
             if not name.startswith('p_'): continue
             if name == 'p_error': continue
@@ -3018,10 +3138,13 @@ class ParserReflect(object):
                 line = func_code(item).co_firstlineno
                 module = inspect.getmodule(item)
                 p_functions.append((line,module,name,item.__doc__))
+                if getattr(item,'passthrough',False):
+                    self.passthrough.append(name)
 
         # Sort all of the actions by line number
         p_functions.sort()
         self.pfuncs = p_functions
+        self.passthrough.sort()
 
 
     # Validate all of the p_functions
@@ -3082,6 +3205,33 @@ class ParserReflect(object):
 
         self.grammar = grammar
 
+# -----------------------------------------------------------------------------
+# passthrough()
+#
+# Decorator marking a rule function whose action only forwards a value,
+# p[0] = p[1], so that the table generator can leave its unit rules out of
+# the parse.  The tree is the same; the action is just never called.
+# -----------------------------------------------------------------------------
+
+def passthrough(f):
+    f.passthrough = True
+    return f
+
+# -----------------------------------------------------------------------------
+# needs_lookahead()
+#
+# Decorator marking a rule function whose action can fail, so that the parser
+# reads and checks the token after the rule before calling it, as it would
+# without defaulted states.  Every rule whose action can raise an exception,
+# SyntaxError included, or record an error for the parser's caller must be
+# marked: unmarked, its error would be reported ahead of a syntax error in
+# the next token.  See LRParser.set_defaulted_states().
+# -----------------------------------------------------------------------------
+
+def needs_lookahead(f):
+    f.needs_lookahead = True
+    return f
+
 # -----------------------------------------------------------------------------
 # yacc(module)
 #
@@ -3194,6 +3344,10 @@ def yacc(method='LALR', debug=yaccdebug, module=None, tabmodule=tab_module, star
     if errors:
         raise YaccError("Unable to build parser")
 
+    # Mark the pass-through rules
+    for prod in grammar.set_passthrough(pinfo.passthrough):
+        errorlog.warning("%s:%d: Rule %r is not a unit rule on a nonterminal; not passed through", prod.file, prod.line, prod.str)
+
     # Verify the grammar structure
     undefined_symbols = grammar.undefined_symbols()
     for sym, prod in undefined_symbols:
@@ -0,0 +1,194 @@
+# Batch parsing of many xproto files over a process pool.
+#
+# Every worker builds one lean ProtobufAnalyzer when it starts and reuses it
+# for all the files it is handed, so the trees it sends back hold no parser
+# objects. Parse failures come back as per-file results instead of aborting
+# the batch.
+#
+# A single large source can be parsed the same way: parse_parallel() cuts it
+# between top-level statements and parses the pieces in the pool.
+
+import gc
+import multiprocessing
+import re
+from collections import namedtuple
+
+from .helpers import Base, find_block_comment_end
+from .incremental import shift
+from .parser import ParsingError, ProtobufAnalyzer, PythonError, \
+    find_policy_end
+from .scanner import STRING_LITERAL
+from .source import LineTable
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+ParseResult = namedtuple('ParseResult', ['path', 'tree', 'error'])
+
+_analyzer = None
+
+
+def _init_worker(cachedir):
+    global _analyzer
+    _analyzer = ProtobufAnalyzer(cachedir, lean=True)
+
+
+def _parse_one(path):
+    try:
+        tree = _analyzer.parse_file(path)
+    except (ParsingError, PythonError, EnvironmentError) as e:
+        return ParseResult(path, None, e)
+    return ParseResult(path, tree, None)
+
+
+def parse_files(paths, jobs=None, chunksize=None, cachedir=None):
+    '''
+    Parse every file in paths and return a list of ParseResult in the same
+    order. jobs defaults to the number of CPUs; files are handed to workers
+    chunksize at a time (by default about four chunks per worker).
+    '''
+    paths = list(paths)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1 or len(paths) <= 1:
+        _init_worker(cachedir)
+        return [_parse_one(path) for path in paths]
+
+    if chunksize is None:
+        chunksize = max(1, len(paths) // (jobs * 4))
+    pool = multiprocessing.Pool(jobs, _init_worker, (cachedir,))
+    try:
+        return pool.map(_parse_one, paths, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Characters that open or close a brace level, end a statement, or start a
+# token that may contain them (strings, comments, policy bodies).
+SPECIAL = re.compile(r'[{};"/<]')
+
+
+def top_level_cuts(code, size):
+    '''
+    Positions at which code can be cut into pieces of roughly size
+    characters that hold whole top-level statements: just after a ';' or
+    '}' or policy body outside any braces. Strings, comments and policy
+    bodies are skipped the way the lexer skips them.
+    '''
+    cuts = []
+    depth = 0
+    target = size
+    pos = 0
+    search = SPECIAL.search
+    while True:
+        m = search(code, pos)
+        if m is None:
+            return cuts
+        pos = m.start()
+        c = code[pos]
+        end = pos + 1
+        if c == '{':
+            depth += 1
+            pos = end
+            continue
+        elif c == '}':
+            depth -= 1
+        elif c == '"':
+            m = STRING_LITERAL.match(code, pos)
+            pos = end if m is None else m.end()
+            continue
+        elif c == '/':
+            if code.startswith('/*', pos):
+                stop = find_block_comment_end(code, pos + 2)
+                if stop != -1:
+                    end = stop
+            elif code.startswith('//', pos):
+                stop = code.find('\n', pos)
+                end = len(code) if stop == -1 else stop
+            pos = end
+            continue
+        elif c == '<':
+            stop = find_policy_end(code, pos + 1)
+            if stop == -1:
+                pos = end
+                continue
+            end = stop
+        pos = end
+        if depth == 0 and end >= target:
+            cuts.append(end)
+            target = end + size
+
+
+# Trees are large graphs of small objects. Pickling and unpickling them
+# allocates no garbage, but would set off the cyclic collector over and
+# over.
+def _without_gc(f, *args):
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return f(*args)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# Pieces come back pickled, by the worker, so that it can do it without the
+# collector; see _without_gc.
+def _parse_chunk(chunk):
+    start, lineno, code = chunk
+    try:
+        tree = _analyzer.parse_string(code, lineno=lineno)
+    except (ParsingError, PythonError):
+        return None
+    shift(tree.body, start, 0)
+    tree.diagnostics = [d._replace(lexpos=d.lexpos + start)
+                        for d in tree.diagnostics]
+    return _without_gc(pickle.dumps, tree, pickle.HIGHEST_PROTOCOL)
+
+
+def parse_parallel(code, jobs=None, chunksize=1 << 16, cachedir=None):
+    '''
+    Parse a single source over a process pool and return the tree a serial
+    parse_string(code) would give. code is cut between top-level statements
+    into pieces of at least max(chunksize, len(code) // (jobs * 4) + 1)
+    characters, so a large source makes at most about four pieces per
+    worker, and the trees of the pieces are joined. With one job, or on a
+    machine with one CPU whatever jobs is, code is parsed serially: the
+    workers could only take turns, and sending their trees back would cost
+    more than they save. If a piece does not parse, the whole source is
+    parsed serially, which raises the error a serial parse raises.
+    '''
+    cpus = multiprocessing.cpu_count()
+    if jobs is None:
+        jobs = cpus
+    chunksize = max(chunksize, len(code) // (jobs * 4) + 1)
+    cuts = top_level_cuts(code, chunksize) if jobs > 1 and cpus > 1 else []
+    if not cuts:
+        _init_worker(cachedir)
+        return _analyzer.parse_string(code)
+
+    lines = LineTable(code, 1, 1)
+    bounds = [0] + cuts + [len(code)]
+    chunks = [(a, lines.position(a + 1)[0], code[a:b])
+              for a, b in zip(bounds, bounds[1:])]
+    pool = multiprocessing.Pool(jobs, _init_worker, (cachedir,))
+    try:
+        trees = pool.map(_parse_chunk, chunks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    if None in trees:
+        _init_worker(cachedir)
+        return _analyzer.parse_string(code)
+
+    trees = [_without_gc(pickle.loads, t) for t in trees]
+    tree = trees[0]
+    for t in trees[1:]:
+        tree.body.extend(t.body)
+        tree.diagnostics.extend(t.diagnostics)
+    Base.p(tree.body, tree)
+    tree.lines = lines
+    return tree
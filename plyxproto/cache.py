@@ -0,0 +1,360 @@
+# Caches of parse results.
+#
+# DiskCache keeps one file per parsed source in a directory, named after a
+# digest of the source text, the parse options (lexer backend, parser engine
+# and lean mode included) and a signature of the parser itself (the lexer and
+# grammar signatures the table cache uses, plus the code of every module that
+# lexes, parses or builds trees, PLY's included, so a changed rule action or
+# scanner never picks up a stale tree). Each file holds the pickled tree,
+# zlib-compressed.
+#
+# Entries are written to a temporary file and renamed into place, so any
+# number of processes can share a directory: a reader sees a whole entry or
+# none. Reading an entry touches its mtime; when the directory grows past
+# max_bytes the entries least recently used are removed first. The size is
+# checked each time a cache object has written another max_bytes / 8, so the
+# directory can overshoot by that much per process.
+#
+# MemoryCache keeps the same pickled trees in process, for long-running
+# services, within a budget counted in tree nodes. Every hit unpickles a new
+# copy, so callers can change the trees they get without affecting each
+# other. Files parsed with parse_file are also remembered by path, mtime and
+# size, and a file that has not changed is not read again.
+
+import errno
+import gc
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+
+from ply.yacc import YaccProduction
+
+from . import tables
+from .helpers import Base
+from .incremental import _child_slots
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from io import BytesIO
+except ImportError:
+    from StringIO import StringIO as BytesIO
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'bytes_read',
+                                       'bytes_written', 'evictions'])
+MemoryStats = namedtuple('MemoryStats', ['hits', 'misses', 'evictions',
+                                         'entries', 'nodes'])
+
+SUFFIX = '.tree'
+
+_signature = None
+_signature_lock = threading.Lock()
+
+
+def parser_signature():
+    '''
+    Digest of everything that decides what tree a source parses to: the
+    lexer and grammar signatures of xproto and the policy language and the
+    code of the modules that lex, parse and build trees.
+    '''
+    global _signature
+    if _signature is None:
+        with _signature_lock:
+            if _signature is None:
+                import ply.lex
+                import ply.yacc
+                from . import (helpers, logicparser, lrgen, model, parser,
+                               scanner, source, tokenbuffer)
+                digest = hashlib.sha1()
+                for name, lexmodule, parsemodule in tables.grammars():
+                    digest.update(tables.lexer_signature(lexmodule).encode())
+                    digest.update(tables.grammar_signature(
+                        parsemodule, 'goal').encode())
+                for module in (helpers, logicparser, lrgen, model, parser,
+                               scanner, source, tokenbuffer, ply.lex,
+                               ply.yacc):
+                    digest.update(tables.module_source(module))
+                _signature = digest.hexdigest()
+    return _signature
+
+
+def _drop_productions(obj):
+    if isinstance(obj, YaccProduction):
+        return 'p'
+    return None
+
+
+def _no_production(pid):
+    return None
+
+
+def _dumps(tree):
+    out = BytesIO()
+    pickler = pickle.Pickler(out, pickle.HIGHEST_PROTOCOL)
+    if tree.p is not None:
+        pickler.persistent_id = _drop_productions
+    pickler.dump(tree)
+    return out.getvalue()
+
+
+# Unpickling a tree allocates every node of it. With many trees alive, the
+# collections that triggers take up a third of the time and free nothing
+# (see batch._without_gc).
+def _loads(data):
+    unpickler = pickle.Unpickler(BytesIO(data))
+    unpickler.persistent_load = _no_production
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return unpickler.load()
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def count_nodes(tree):
+    '''Number of nodes in tree, each counted once.'''
+    seen = set()
+    stack = [tree]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node = pop()
+        if type(node) is list:
+            for n in node:
+                if isinstance(n, (list, Base)):
+                    push(n)
+            continue
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for name in _child_slots(type(node)):
+            n = getattr(node, name, None)
+            if isinstance(n, (list, Base)):
+                push(n)
+    return len(seen)
+
+
+class DiskCache(object):
+    '''
+    Parse trees on disk, for ProtobufAnalyzer(cache=...). path defaults to
+    a 'trees' directory in the table cache directory (see tables.cache_dir).
+    Trees come back from the cache without parser objects, as a lean
+    analyzer would build them.
+
+    stats() counts the hits, misses and bytes read and written by this
+    object; several processes sharing a directory each count their own.
+    '''
+
+    def __init__(self, path=None, max_bytes=1 << 28):
+        if path is None:
+            path = os.path.join(tables.cache_dir(), 'trees')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.bytes_read = self.bytes_written = 0
+        self.evictions = 0
+        # Bytes written since the directory was last measured; the first
+        # write measures it.
+        self.unmeasured = max_bytes
+
+    def key(self, code, *options):
+        if not isinstance(code, bytes):
+            code = code.encode('utf-8')
+        digest = hashlib.sha1(parser_signature().encode())
+        digest.update(repr(options).encode())
+        digest.update(code)
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    def get(self, key):
+        '''The tree stored under key, or None.'''
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+            tree = _loads(zlib.decompress(data))
+        except (EnvironmentError, zlib.error, pickle.UnpicklingError,
+                EOFError, AttributeError, ImportError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.bytes_read += len(data)
+        return tree
+
+    def put(self, key, tree):
+        '''Store tree under key. A cache that cannot be written is skipped.'''
+        data = zlib.compress(_dumps(tree), 1)
+        if not tables._writable_dir(self.path):
+            return
+        try:
+            fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        except EnvironmentError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmppath, self._file(key))
+        except EnvironmentError:
+            return
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        with self.lock:
+            self.bytes_written += len(data)
+            self.unmeasured += len(data)
+            evict = self.unmeasured > self.max_bytes // 8
+            if evict:
+                self.unmeasured = 0
+        if evict:
+            self.evict()
+
+    def entries(self):
+        '''(mtime, size, path) of every entry, oldest first.'''
+        found = []
+        try:
+            names = os.listdir(self.path)
+        except EnvironmentError:
+            return found
+        for name in names:
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            found.append((st.st_mtime, st.st_size, path))
+        found.sort()
+        return found
+
+    def disk_usage(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''Remove the least recently used entries down to max_bytes.'''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                # Another process got there first.
+                if e.errno != errno.ENOENT:
+                    continue
+            total -= size
+        with self.lock:
+            self.evictions += removed
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return CacheStats(self.hits, self.misses, self.bytes_read,
+                              self.bytes_written, self.evictions)
+
+
+class MemoryCache(object):
+    '''
+    Parse trees in memory, for ProtobufAnalyzer(cache=...). At most
+    max_nodes tree nodes are kept; the least recently used trees are
+    dropped to make room, and a tree larger than the whole budget is not
+    kept at all. get() returns a new copy of the tree on every hit, without
+    parser objects.
+
+    parse_file() checks the path, mtime and size of a file against those it
+    was last parsed with (see file_key) before reading it.
+    '''
+
+    def __init__(self, max_nodes=1 << 20):
+        self.max_nodes = max_nodes
+        self.lock = threading.Lock()
+        # key -> (nodes, pickled tree), least recently used first.
+        self.trees = OrderedDict()
+        # (path, options) -> (stamp, key) of the last parse of a file.
+        self.files = {}
+        self.nodes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def key(self, code, *options):
+        if not isinstance(code, bytes):
+            code = code.encode('utf-8')
+        digest = hashlib.sha1(repr(options).encode())
+        digest.update(code)
+        return digest.hexdigest()
+
+    def file_key(self, path, stamp, options, key=None):
+        '''
+        With key, record that path, with stamp (its mtime and size), parsed
+        to the tree stored under key. Without, return the key recorded for
+        path if its stamp is still the same, or None.
+        '''
+        path = os.path.abspath(path)
+        with self.lock:
+            if key is not None:
+                self.files[path, options] = (stamp, key)
+                return key
+            entry = self.files.get((path, options))
+        if entry is None or entry[0] != stamp:
+            return None
+        return entry[1]
+
+    def get(self, key):
+        '''A copy of the tree stored under key, or None.'''
+        with self.lock:
+            entry = self.trees.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.trees[key] = entry
+            self.hits += 1
+        return _loads(entry[1])
+
+    def put(self, key, tree):
+        '''Store a copy of tree under key.'''
+        nodes = count_nodes(tree)
+        if nodes > self.max_nodes:
+            return
+        data = _dumps(tree)
+        with self.lock:
+            old = self.trees.pop(key, None)
+            if old is not None:
+                self.nodes -= old[0]
+            self.trees[key] = (nodes, data)
+            self.nodes += nodes
+            while self.nodes > self.max_nodes:
+                _, (n, _) = self.trees.popitem(last=False)
+                self.nodes -= n
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.trees.clear()
+            self.files.clear()
+            self.nodes = 0
+
+    def stats(self):
+        with self.lock:
+            return MemoryStats(self.hits, self.misses, self.evictions,
+                               len(self.trees), self.nodes)
@@ -1,3 +1,130 @@
+import re
+import string
+from collections import namedtuple
+
+try:
+    from copy_reg import __newobj__
+except ImportError:
+    from copyreg import __newobj__
+
+# Trees built by a lean parser (one with its lean attribute set) keep only
+# resolved spans and values, never the YaccProduction they were reduced from.
+def retained_production(p):
+    if getattr(p.parser, 'lean', False):
+        return None
+    return p
+
+
+# A parser with its spans attribute set to False builds structure-only trees:
+# token values stay plain strings instead of LU wrappers, and nodes get no
+# lexspan or linespan.
+def tracks_spans(p):
+    return getattr(p.parser, 'spans', True)
+
+
+# Delimited tokens (block comments, policy bodies, {{ }} escapes) are matched
+# by the lexer on their opening delimiter only. The rule then looks for the
+# closing delimiter with str.find, so scanning stays linear in the input even
+# for huge or unterminated tokens. A failed search is remembered per rule: if
+# nothing closes a token opened at position i, nothing closes one opened later.
+def close_delimited(t, find, fallback):
+    '''
+    Extend token t up to its closing delimiter. find(data, pos) returns the
+    index just past the delimiter, searching from pos, or -1. If the token is
+    never closed, t becomes the one-character token of type fallback that the
+    lexer would have produced for the opening character, and False is returned.
+    '''
+    lexer = t.lexer
+    data = lexer.lexdata
+    start = t.lexpos
+    memo = getattr(lexer, 'unterminated', None)
+    if memo is None or memo[0] is not data:
+        memo = lexer.unterminated = (data, {})
+    end = -1
+    if start < memo[1].get(t.type, start + 1):
+        end = find(data, lexer.lexpos)
+        if end == -1:
+            memo[1][t.type] = start
+    if end == -1:
+        t.type = fallback
+        t.value = data[start]
+        lexer.lexpos = start + 1
+        return False
+    t.value = data[start:end]
+    lexer.lexpos = end
+    lexer.lineno += data.count('\n', start, end)
+    return True
+
+
+def find_block_comment_end(data, pos):
+    end = data.find('*/', pos)
+    return end if end == -1 else end + 2
+
+
+# A lexical error: a run of length characters starting with char at lexpos
+# that no token rule accepts.
+Diagnostic = namedtuple('Diagnostic', ['lexpos', 'lineno', 'char', 'length'])
+
+
+def illegal_chars(lexer):
+    '''
+    Regex for runs of characters that cannot start any token of the lexer
+    module: not ignored, not a literal and not the first character of a rule.
+    '''
+    legal = lexer.t_ignore + lexer.literals + string.ascii_letters + \
+        string.digits + '_$"\r\n'
+    return re.compile('[^%s]+' % re.escape(legal))
+
+
+def skip_illegal(t, illegal):
+    '''
+    Error handling shared by the lexers. Skips the whole run of illegal
+    characters at t.lexpos at once (a single character if it is only illegal
+    where it stands, like an unterminated quote). The error is appended to
+    t.lexer.diagnostics when the lexer has that list, and printed otherwise.
+    '''
+    lexer = t.lexer
+    data = lexer.lexdata
+    m = illegal.match(data, t.lexpos)
+    length = m.end() - t.lexpos if m else 1
+    char = data[t.lexpos]
+    diagnostics = getattr(lexer, 'diagnostics', None)
+    if diagnostics is None:
+        print("Illegal character '{}' ({}) in line {}".format(
+            char, hex(ord(char)), lexer.lineno))
+    else:
+        diagnostics.append(Diagnostic(t.lexpos, lexer.lineno, char, length))
+    lexer.skip(length)
+
+
+class NameTable(object):
+    '''
+    Interns identifier strings. Lexers and parse sessions that share a table
+    keep a single string object for every occurrence of a name (identifiers,
+    keywords, dotted type names), across all the files they parse.
+    '''
+
+    def __init__(self):
+        self.names = {}
+
+    def intern(self, name):
+        return self.names.setdefault(name, name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+def intern_name(lexer, name):
+    '''name, interned in lexer's NameTable if it has one.'''
+    names = getattr(lexer, 'names', None)
+    if names is None:
+        return name
+    return names.intern(name)
+
+
 class LexHelper:
     offset = 0
 
@@ -45,17 +172,129 @@ class LexHelper:
             return (0, 0)
         return tuple([mSpan[0] - self.offset, mSpan[1] - self.offset])
 
+    def get_spans(self, p):
+        '''
+        Return (linespan, lexspan) of production p in one pass over its
+        symbols. Gives the same result as get_max_linespan() and
+        get_max_lexspan(), which walk the production once each.
+        '''
+        line0 = line1 = pos0 = pos1 = None
+        for sym in p.slice:
+            start = getattr(sym, 'lineno', 0)
+            end = getattr(sym, 'endlineno', start)
+            if start == 0 and end == 0:
+                span = getattr(sym.value, 'linespan', None)
+                if span is not None and len(span) == 2 and \
+                        (span[0] != 0 or span[1] != 0):
+                    start, end = span
+            if start != 0 or end != 0:
+                if line0 is None:
+                    line0, line1 = start, end
+                else:
+                    if start < line0:
+                        line0 = start
+                    if end > line1:
+                        line1 = end
+
+            start = getattr(sym, 'lexpos', 0)
+            end = getattr(sym, 'endlexpos', start)
+            if start == 0 and end == 0:
+                span = getattr(sym.value, 'lexspan', None)
+                if span is not None and len(span) == 2 and \
+                        (span[0] != 0 or span[1] != 0):
+                    start, end = span
+            if start != 0 or end != 0:
+                if pos0 is None:
+                    pos0, pos1 = start, end
+                else:
+                    if start < pos0:
+                        pos0 = start
+                    if end > pos1:
+                        pos1 = end
+
+        offset = self.offset
+        linespan = (0, 0) if line0 is None else \
+            (line0 - offset, line1 - offset)
+        lexspan = (0, 0) if pos0 is None else (pos0 - offset, pos1 - offset)
+        return linespan, lexspan
+
     def set_parse_object(self, dst, p):
-        dst.setLexData(
-            linespan=self.get_max_linespan(p),
-            lexspan=self.get_max_lexspan(p))
-        dst.setLexObj(p)
+        if not tracks_spans(p):
+            return
+        linespan, lexspan = self.get_spans(p)
+        dst.setLexData(linespan=linespan, lexspan=lexspan)
+        dst.setLexObj(retained_production(p))
+
+
+# Slot names by class, all the way up the MRO. Pickling and comparing trees
+# look them up once per node.
+_slot_names = {}
+
+
+def _slots(cls):
+    names = _slot_names.get(cls)
+    if names is None:
+        names = []
+        for klass in reversed(cls.__mro__):
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        names = _slot_names[cls] = tuple(names)
+    return names
 
 
 class Base(object):
-    parent = None
-    lexspan = None
-    linespan = None
+    # Trees hold one object per token and per production, so nodes keep their
+    # attributes in slots rather than in a per-instance __dict__.
+    __slots__ = ('parent', 'lexspan', 'linespan')
+    # Slots that say how a node was parsed rather than what it is, left out
+    # when comparing nodes. parent also points back up the tree, so comparing
+    # it would recurse forever.
+    _uncompared = ('parent',)
+
+    def __init__(self):
+        self.parent = None
+        self.lexspan = None
+        self.linespan = None
+
+    def __eq__(self, other):
+        try:
+            mine = self.__getstate__()
+            theirs = other.__getstate__()
+        except AttributeError:
+            return False
+        for k in self._uncompared:
+            mine.pop(k, None)
+            theirs.pop(k, None)
+        return mine == theirs
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        state = {}
+        for k in _slots(type(self)):
+            try:
+                state[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        return state
+
+    # Pickles hold the slot values as a tuple in _slots() order, which is
+    # smaller and quicker to write and read than the __getstate__ dict.
+    # Trees cross process boundaries in batch parsing.
+    def __reduce_ex__(self, protocol):
+        cls = type(self)
+        return (__newobj__, (cls,),
+                tuple([getattr(self, k, None) for k in _slots(cls)]))
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = state.items()
+        else:
+            state = zip(_slots(type(self)), state)
+        for k, v in state:
+            setattr(self, k, v)
 
     def v(self, obj, visitor):
         if obj is None:
@@ -81,9 +320,12 @@ class Base(object):
 
 
 class LU(Base):
+    __slots__ = ('p', 'idx', 'pval')
+    _uncompared = ('parent', 'p', 'idx')
 
     def __init__(self, p, idx):
-        self.p = p
+        super(LU, self).__init__()
+        self.p = retained_production(p)
         self.idx = idx
         self.pval = p[idx]
         self.lexspan = p.lexspan(idx)
@@ -97,13 +339,19 @@ class LU(Base):
                 and self.lexspan[0] != 0:
             self.lexspan = tuple(
                 [self.lexspan[0], self.lexspan[0] + len(self.pval)])
-        super(LU, self).__init__()
 
     @staticmethod
     def i(p, idx):
         if isinstance(p[idx], LU):
             return p[idx]
-        if isinstance(p[idx], str):
+        if isinstance(p[idx], str) and tracks_spans(p):
+            return LU(p, idx)
+        return p[idx]
+
+    @staticmethod
+    def wrap(p, idx):
+        '''p[idx] in an LU, or as it is when the parser tracks no spans.'''
+        if tracks_spans(p):
             return LU(p, idx)
         return p[idx]
 
@@ -131,10 +379,12 @@ class SourceElement(Base):
     A SourceElement is the base class for all elements that occur in a Protocol Buffers
     file parsed by plyproto.
     '''
+    __slots__ = ('p',)
+    _fields = ()  # subclasses list their own, e.g. ('name', 'body')
+    _uncompared = ('parent', 'p')
 
     def __init__(self, linespan=[], lexspan=[], p=None):
         super(SourceElement, self).__init__()
-        self._fields = []  # ['linespan', 'lexspan']
         self.linespan = linespan
         self.lexspan = lexspan
         self.p = p
@@ -145,15 +395,6 @@ class SourceElement(Base):
         args = ", ".join(equals)
         return "{0}({1})".format(self.__class__.__name__, args)
 
-    def __eq__(self, other):
-        try:
-            return self.__dict__ == other.__dict__
-        except AttributeError:
-            return False
-
-    def __ne__(self, other):
-        return not self == other
-
     def setLexData(self, linespan, lexspan):
         self.linespan = linespan
         self.lexspan = lexspan
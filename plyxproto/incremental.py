@@ -0,0 +1,150 @@
+# Incremental reparsing of edited sources.
+#
+# A source is split into top-level regions: each statement of the tree owns
+# the text from its first token up to the first token of the next statement
+# (the first one also owns whatever precedes it, the last one everything to
+# the end). An edit only reparses the regions it touches. The statements of
+# the other regions are reused, those after the edit with their spans moved
+# by the length and line count of the edit, and the line table is the old one
+# with the edit applied rather than a rescan of the whole source. When the
+# reparsed text does not come out as whole statements ending where the next
+# region begins (an edit that opens a comment or drops a closing brace, say),
+# or fails to parse, the whole source is parsed instead, so the result is
+# always that of a full parse.
+#
+# Reusing statements moves them: the new tree takes them over, in place,
+# rather than copying every statement an edit did not touch. This happens
+# only once the new tree is complete; until then nothing in the old tree is
+# changed, so an edit that fails or falls back to a full parse leaves it as
+# it was.
+
+from bisect import bisect_right
+
+from .helpers import Base, _slots
+from .parser import ParsingError
+
+
+# Per node class, the slots shift() walks into.
+_children = {}
+
+
+def _child_slots(cls):
+    names = _children.get(cls)
+    if names is None:
+        names = _children[cls] = tuple(
+            k for k in _slots(cls)
+            if k not in ('parent', 'p', 'lexspan', 'linespan'))
+    return names
+
+
+def shift(node, lexdelta, linedelta):
+    '''
+    Move the lexspan and linespan of node and everything below it by
+    lexdelta and linedelta. Empty spans stay as they are, and nodes reached
+    twice are moved once.
+    '''
+    seen = set()
+    stack = [node] if isinstance(node, (list, Base)) else []
+    pop = stack.pop
+    push = stack.append
+    children = _children
+    while stack:
+        node = pop()
+        if type(node) is list:
+            for n in node:
+                if isinstance(n, (list, Base)):
+                    push(n)
+            continue
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        span = node.lexspan
+        if span and (span[0] or span[1]):
+            node.lexspan = (span[0] + lexdelta, span[1] + lexdelta)
+        span = node.linespan
+        if span and (span[0] or span[1]):
+            node.linespan = (span[0] + linedelta, span[1] + linedelta)
+        cls = type(node)
+        names = children.get(cls) or _child_slots(cls)
+        for name in names:
+            n = getattr(node, name, None)
+            if isinstance(n, (list, Base)):
+                push(n)
+
+
+def _has_spans(statements):
+    for s in statements:
+        span = getattr(s, 'lexspan', None)
+        if not span or span[0] == 0:
+            return False
+    return True
+
+
+def reparse(analyzer, tree, code, start, end, text, prefix='+'):
+    '''
+    Apply an edit to code, the source tree was parsed from with analyzer:
+    replace code[start:end] with text. Returns the new source and its tree,
+    the same as analyzer.parse_string() would give for it.
+
+    Only the top-level statements the edit touches are parsed again; the
+    others are moved over from tree, in place: their spans are shifted and
+    their parent becomes the new tree, so tree must not be used once the
+    new tree is returned. Raises ParsingError (or PythonError) like a full
+    parse when the new source does not parse; tree is then left as it was,
+    as it is when the edit falls back to a full parse.
+    '''
+    new_code = code[:start] + text + code[end:]
+    body = tree.body
+    if tree.errors or not body or not _has_spans(body):
+        return new_code, analyzer.parse_string(new_code, prefix=prefix)
+
+    offset = len(prefix)
+    # Region i is code[bounds[i]:bounds[i + 1]].
+    bounds = [0] + [s.lexspan[0] - offset for s in body[1:]] + [len(code)]
+    # An edit can join a token to the character before it, or close a
+    # string opened by a stray quote earlier on its line (skipped as an
+    # illegal character until then).
+    line_start = code.rfind('\n', 0, start) + 1
+    first = bisect_right(bounds, max(min(start - 1, line_start), 0)) - 1
+    last = min(bisect_right(bounds, end) - 1, len(body) - 1)
+
+    delta = len(text) - (end - start)
+    linedelta = text.count('\n') - code.count('\n', start, end)
+    region_start = bounds[first] + offset
+    region_end = bounds[last + 1] + offset + delta
+    if first == 0:
+        lineno = tree.lines.lineno
+    else:
+        lineno = body[first].linespan[0]
+
+    source = prefix + new_code
+    lines = tree.lines.edited(start, end, text)
+    before = [d for d in tree.diagnostics if d.lexpos < region_start]
+    try:
+        region, stop = analyzer.session().parse_region(
+            source, region_start, region_end, lines, lineno)
+    except ParsingError as e:
+        # The statements before the region parse as they did, so an error
+        # in the region is the first error of a full parse too. Except at
+        # its first token: that stops the statement before from being
+        # reduced (and a policy in it from adding its diagnostics).
+        if e.error_range[1] <= region_start:
+            return new_code, analyzer.parse_string(new_code, prefix=prefix)
+        e.diagnostics = before + e.diagnostics
+        raise
+    if region is None or stop != region_end:
+        return new_code, analyzer.parse_string(new_code, prefix=prefix)
+
+    after = body[last + 1:]
+    shift(after, delta, linedelta)
+    old_end = bounds[last + 1] + offset
+    diagnostics = before
+    diagnostics.extend(region.diagnostics)
+    diagnostics.extend(
+        d._replace(lexpos=d.lexpos + delta, lineno=d.lineno + linedelta)
+        for d in tree.diagnostics if d.lexpos >= old_end)
+
+    region.body = body[:first] + region.body + after
+    Base.p(region.body, region)
+    region.diagnostics = diagnostics
+    return new_code, region
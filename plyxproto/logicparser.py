@@ -3,7 +3,14 @@ __author__ = "Sapan Bhatia"
 __copyright__ = "Copyright (C) 2017 Open Networking Lab"
 __version__ = "1.0"
 
-from helpers import LexHelper
+from helpers import (
+    LexHelper,
+    close_delimited,
+    find_block_comment_end,
+    illegal_chars,
+    intern_name,
+    skip_illegal,
+)
 
 
 class FOLParsingError(Exception):
@@ -12,6 +19,14 @@ class FOLParsingError(Exception):
         super(FOLParsingError, self).__init__(message)
         self.error_range = error_range
 
+    def __reduce__(self):
+        return (self.__class__, (self.args[0], self.error_range))
+
+
+def find_escape_end(data, pos):
+    end = data.find('}}', pos)
+    return end if end == -1 else end + 2
+
 
 class FOLLexer(object):
     keywords = ('forall', 'exists', 'True', 'False', 'not', 'in')
@@ -60,30 +75,35 @@ class FOLLexer(object):
         t.lexer.lineno += len(t.value) / 2
 
     def t_ESCAPE(self, t):
-        r'{{ (.|\n)*? }}'
-        t.lexer.lineno += t.value.count('\n')
+        r'{{'
+        close_delimited(t, find_escape_end, '{')
         return t
 
     def t_BLOCK_COMMENT(self, t):
-        r'/\*(.|\n)*?\*/'
-        t.lexer.lineno += t.value.count('\n')
+        r'/\*'
+        if not close_delimited(t, find_block_comment_end, '/'):
+            return t
 
     def t_SYMBOL(self, t):
         '[A-Za-z_$][\.A-Za-z0-9_+$]*(\(\))?'
         if t.value in FOLLexer.keywords:
             t.type = t.value.upper()
+        t.value = intern_name(t.lexer, t.value)
         return t
 
     def t_error(self, t):
-        print("Illegal character '{}' ({}) in line {}".format(
-            t.value[0], hex(ord(t.value[0])), t.lexer.lineno))
-        t.lexer.skip(1)
+        skip_illegal(t, FOLLexer.illegal)
+
+
+FOLLexer.illegal = illegal_chars(FOLLexer)
 
 
 class FOLParser(object):
     tokens = FOLLexer.tokens
     offset = 0
-    lh = LexHelper()
+
+    def __init__(self):
+        self.lh = LexHelper()
 
     def setOffset(self, of):
         self.offset = of
@@ -149,7 +169,10 @@ class FOLParser(object):
         '''goal : LT fole RT'''
         p[0] = p[2]
 
+    # At end of input there is no token to point at; error_range is None.
     def p_error(self, p):
+        if p is None:
+            raise FOLParsingError('error: unexpected end of input', None)
         error = 'error: {}'.format(p)
         raise FOLParsingError(error, (p.lineno, p.lexpos, len(p.value)))
 
@@ -0,0 +1,463 @@
+# Specialized LR parsers.
+#
+# generate() writes out the LR table of one grammar, together with the parts
+# of its rule actions that are simple enough to copy, as the source of a
+# Python module with a parser for that grammar alone. States, terminals and
+# nonterminals are numbered, so the tables are lists indexed by number
+# instead of dicts keyed by symbol name, and a token type is looked up once
+# when the token is read rather than once per action. Actions that only pass
+# a value on (p[0] = p[1]), start a list or append to one are done in the
+# parse loop itself. The others are called as PLY calls them, with a
+# YaccProduction that also holds the values of its symbols as list items
+# (see Production), so the trees are the same.
+#
+# The generated Parser is an LRParser: parse(debug=...) falls back to PLY's
+# own engine, which works from the dict tables the parser is built with.
+
+import ast
+import inspect
+import sys
+import textwrap
+
+import ply.yacc as yacc
+from ply.yacc import LRParser, YaccProduction, YaccSymbol
+
+# How a rule's action is carried out: by calling it, or inline.
+CALL, NONE, COPY, NEWLIST, WRAP, APPEND = range(6)
+
+
+def _const(node):
+    '''The value of a number or None literal; anything else gives Ellipsis.'''
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Name) and node.id == 'None':
+        return None
+    if type(node).__name__ in ('Constant', 'NameConstant'):
+        return node.value
+    return Ellipsis
+
+
+def _item(node, p):
+    '''k for a node p[k] with a literal k, or None.'''
+    if not isinstance(node, ast.Subscript) or \
+            not isinstance(node.value, ast.Name) or node.value.id != p:
+        return None
+    index = node.slice
+    if isinstance(index, ast.Index):
+        index = index.value
+    k = _const(index)
+    if isinstance(k, int) and not isinstance(k, bool):
+        return k
+    return None
+
+
+def _len_test(node, p):
+    '''n for a node len(p) == n, or None.'''
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1 or \
+            not isinstance(node.ops[0], ast.Eq):
+        return None
+    call = node.left
+    if not isinstance(call, ast.Call) or \
+            not isinstance(call.func, ast.Name) or call.func.id != 'len' or \
+            len(call.args) != 1 or not isinstance(call.args[0], ast.Name) or \
+            call.args[0].id != p:
+        return None
+    n = _const(node.comparators[0])
+    return n if isinstance(n, int) else None
+
+
+def _sets(stmt, p):
+    '''The value node assigned by a statement p[0] = value, or None.'''
+    if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and \
+            _item(stmt.targets[0], p) == 0:
+        return stmt.value
+    return None
+
+
+def classify(func, length):
+    '''
+    (kind, k) describing what func, the action of a rule with length
+    symbols on its right-hand side, does when it can be done inline:
+    NONE sets no value, COPY passes p[k] on, NEWLIST gives [], WRAP gives
+    [p[k]] and APPEND appends p[k] to the list in p[1] and passes it on.
+    (CALL, None) for any other action.
+    '''
+    try:
+        source = textwrap.dedent(inspect.getsource(func))
+        tree = ast.parse(source)
+    except (IOError, OSError, TypeError, SyntaxError):
+        return CALL, None
+    defn = tree.body[0]
+    args = defn.args.args
+    if len(args) != 2:
+        return CALL, None
+    p = getattr(args[1], 'arg', None) or getattr(args[1], 'id', None)
+    body = defn.body
+    if body and isinstance(body[0], ast.Expr) and \
+            isinstance(body[0].value, ast.Str):
+        body = body[1:]
+    # The branch of an 'if len(p) == n:' taken for this rule.
+    while len(body) == 1 and isinstance(body[0], ast.If):
+        n = _len_test(body[0].test, p)
+        if n is None:
+            return CALL, None
+        body = body[0].body if n == length + 1 else body[0].orelse
+
+    if not body or (len(body) == 1 and isinstance(body[0], ast.Pass)):
+        return NONE, None
+    if len(body) == 1:
+        value = _sets(body[0], p)
+        if value is None:
+            return CALL, None
+        k = _item(value, p)
+        if k is not None and 1 <= k <= length:
+            return COPY, k
+        if isinstance(value, ast.List):
+            if not value.elts:
+                return NEWLIST, None
+            if len(value.elts) == 1:
+                k = _item(value.elts[0], p)
+                if k is not None and 1 <= k <= length:
+                    return WRAP, k
+        if _const(value) is None:
+            return NONE, None
+        return CALL, None
+    if len(body) != 2 or not isinstance(body[0], ast.Expr):
+        return CALL, None
+    call = body[0].value
+    value = _sets(body[1], p)
+    if isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) \
+            and call.func.attr == 'append' and \
+            _item(call.func.value, p) == 1 and len(call.args) == 1 and \
+            not call.keywords and value is not None and _item(value, p) == 1:
+        k = _item(call.args[0], p)
+        if k is not None and 2 <= k <= length:
+            return APPEND, k
+    return CALL, None
+
+
+def _sparse(rows, ids):
+    return '[\n%s]' % ''.join(
+        '    {%s},\n' % ', '.join('%d: %d' % (ids[k], v)
+                                  for k, v in sorted(row.items()))
+        for row in rows)
+
+
+def generate(table, module, signature=None):
+    '''
+    Source of a parser module for the LR table built from module (the rule
+    instance). signature is written into the module as _signature, for
+    the caller to check it still matches.
+    '''
+    states = len(table.lr_action)
+    terminals = set()
+    for row in table.lr_action.values():
+        terminals.update(row)
+    terminals.update(['$end', 'error'])
+    terminals = sorted(terminals)
+    terminal_ids = dict((t, i) for i, t in enumerate(terminals))
+    nonterminals = set(p.name for p in table.lr_productions)
+    for row in table.lr_goto.values():
+        nonterminals.update(row)
+    nonterminals = sorted(nonterminals)
+    nonterminal_ids = dict((n, i) for i, n in enumerate(nonterminals))
+
+    rules = []
+    for number, p in enumerate(table.lr_productions):
+        kind, k = CALL, None
+        if p.func:
+            kind, k = classify(getattr(module, p.func), p.len)
+        # Index into the symbol stack of p[k] before the rule's symbols
+        # are popped.
+        arg = 0 if k is None else k - p.len - 1
+        rules.append((p.len, nonterminal_ids[p.name], p.name, kind, arg,
+                      p.str))
+
+    lines = [
+        '# This file is automatically generated. Do not edit.',
+        '# A parser for one grammar; see plyxproto.lrgen.',
+        '',
+        'from plyxproto.lrgen import Parser as _Parser, dense as _dense',
+        '',
+        '_signature = %r' % (signature,),
+        '',
+        '# Terminal and nonterminal numbers.',
+        'TERMINALS = {%s}' % ', '.join(
+            '%r: %d' % (t, i) for i, t in enumerate(terminals)),
+        'NONTERMINALS = %r' % (tuple(nonterminals),),
+        '',
+        '# ACTION[state][terminal] and GOTO[state][nonterminal]: > 0 shifts',
+        '# to a state, < 0 reduces by a rule, 0 accepts and None is an error.',
+        'ACTION = _dense(%s, %d)' % (
+            _sparse([table.lr_action[s] for s in range(states)],
+                    terminal_ids), len(terminals) + 1),
+        'GOTO = _dense(%s, %d)' % (
+            _sparse([table.lr_goto.get(s, {}) for s in range(states)],
+                    nonterminal_ids), len(nonterminals)),
+        '',
+        '# Per rule: length, left-hand side, its name, the kind of action',
+        '# (see lrgen.CALL and following) and the stack index it reads.',
+        'RULES = [',
+    ]
+    for length, lhs, name, kind, arg, text in rules:
+        lines.append('    (%d, %d, %r, %d, %d),  # %s' % (
+            length, lhs, name, kind, arg, text))
+    lines.extend([
+        ']',
+        '',
+        '',
+        'class Parser(_Parser):',
+        '    terminals = TERMINALS',
+        '    actions = ACTION',
+        '    gotos = GOTO',
+        '    rules = RULES',
+        '    end = TERMINALS[\'$end\']',
+        '    error = TERMINALS[\'error\']',
+        '    unknown = len(TERMINALS)',
+        '',
+    ])
+    return '\n'.join(lines)
+
+
+def dense(rows, width):
+    '''Lists of width entries from dicts of the entries that are set.'''
+    out = []
+    for row in rows:
+        line = [None] * width
+        for k, v in row.items():
+            line[k] = v
+        out.append(line)
+    return out
+
+
+class Production(list, YaccProduction):
+    '''
+    The p of rule actions. p[n] reads the value of symbol n from the list
+    itself instead of going through YaccProduction.__getitem__, which is
+    most of the cost of an action that reads a few symbols. Assigning p[n]
+    also sets the value on the symbol, as in PLY. Unlike PLY, negative
+    indexes count from the end of the rule, not into the symbol stack.
+    '''
+
+    __getitem__ = list.__getitem__
+    __len__ = list.__len__
+
+    def __init__(self, lexer, parser, stack):
+        list.__init__(self)
+        self.slice = None
+        self.stack = stack
+        self.lexer = lexer
+        self.parser = parser
+
+    def __setitem__(self, n, v):
+        list.__setitem__(self, n, v)
+        self.slice[n].value = v
+
+
+class Parser(LRParser):
+    '''
+    The parse loop of generated parsers, which subclass it with their
+    tables. Built like an LRParser, from the grammar's LRTable with the
+    productions bound to the rule functions; parse() gives the same results
+    and calls p_error on the same tokens as LRParser.parse().
+    '''
+
+    def __init__(self, lrtab, errorf):
+        LRParser.__init__(self, lrtab, errorf)
+        self.callables = [
+            p.callable if rule[3] == CALL else None
+            for p, rule in zip(self.productions, self.rules)]
+
+    def set_defaulted_states(self):
+        LRParser.set_defaulted_states(self)
+        # The same, as a list indexed by state.
+        self.defaults = [None] * len(self.actions)
+        for state, rule in self.defaulted_states.items():
+            self.defaults[state] = rule
+
+    def disable_defaulted_states(self):
+        LRParser.disable_defaulted_states(self)
+        self.defaults = [None] * len(self.actions)
+
+    def parse(self, input=None, lexer=None, debug=0, tracking=0,
+              tokenfunc=None):
+        if debug or tracking or yacc.yaccdevel:
+            return LRParser.parse(self, input, lexer, debug, tracking,
+                                  tokenfunc)
+
+        lookahead = None
+        lookaheadstack = []
+        terminals = self.terminals
+        actions = self.actions
+        gotos = self.gotos
+        defaults = self.defaults
+        rules = self.rules
+        callables = self.callables
+        unknown = self.unknown
+        errorcount = 0
+        error_count = yacc.error_count
+        setvalues = list.__setitem__
+        everything = slice(None)
+
+        if not lexer:
+            lexer = yacc.load_ply_lex().lexer
+        if input is not None:
+            lexer.input(input)
+        get_token = lexer.token if tokenfunc is None else tokenfunc
+        self.token = get_token
+
+        statestack = [0]
+        self.statestack = statestack
+        sym = YaccSymbol()
+        sym.type = '$end'
+        symstack = [sym]
+        self.symstack = symstack
+        pslice = Production(lexer, self, symstack)
+        state = 0
+        # The number of lookahead.type.
+        ltype = None
+
+        while 1:
+            t = defaults[state]
+            if t is None:
+                if lookahead is None:
+                    if lookaheadstack:
+                        lookahead = lookaheadstack.pop()
+                    else:
+                        lookahead = get_token()
+                    if lookahead is None:
+                        lookahead = YaccSymbol()
+                        lookahead.type = '$end'
+                    ltype = terminals.get(lookahead.type, unknown)
+
+                t = actions[state][ltype]
+
+            if t is not None:
+                if t > 0:
+                    statestack.append(t)
+                    state = t
+                    symstack.append(lookahead)
+                    lookahead = None
+                    if errorcount:
+                        errorcount -= 1
+                    continue
+
+                if t < 0:
+                    plen, lhs, name, kind, arg = rules[-t]
+                    sym = YaccSymbol()
+                    sym.type = name
+                    if kind:
+                        if kind == COPY:
+                            sym.value = symstack[arg].value
+                        elif kind == APPEND:
+                            value = symstack[-plen].value
+                            value.append(symstack[arg].value)
+                            sym.value = value
+                        elif kind == WRAP:
+                            sym.value = [symstack[arg].value]
+                        elif kind == NEWLIST:
+                            sym.value = []
+                        else:
+                            sym.value = None
+                        if plen:
+                            del symstack[-plen:]
+                            del statestack[-plen:]
+                        symstack.append(sym)
+                        state = gotos[statestack[-1]][lhs]
+                        statestack.append(state)
+                        continue
+
+                    sym.value = None
+                    if plen:
+                        targ = symstack[-plen - 1:]
+                        targ[0] = sym
+                        setvalues(pslice, everything,
+                                  [s.value for s in targ])
+                    else:
+                        targ = [sym]
+                        setvalues(pslice, everything, [None])
+                    pslice.slice = targ
+                    try:
+                        if plen:
+                            del symstack[-plen:]
+                            del statestack[-plen:]
+                        callables[-t](pslice)
+                        symstack.append(sym)
+                        state = gotos[statestack[-1]][lhs]
+                        statestack.append(state)
+                    except SyntaxError:
+                        if lookahead is not None:
+                            lookaheadstack.append(lookahead)
+                        symstack.pop()
+                        statestack.pop()
+                        state = statestack[-1]
+                        sym.type = 'error'
+                        lookahead = sym
+                        ltype = self.error
+                        errorcount = error_count
+                        self.errorok = 0
+                    continue
+
+                return getattr(symstack[-1], 'value', None)
+
+            # A syntax error: the same recovery as LRParser.parseopt().
+            if errorcount == 0 or self.errorok:
+                errorcount = error_count
+                self.errorok = 0
+                errtoken = lookahead
+                if errtoken.type == '$end':
+                    errtoken = None
+                if self.errorfunc:
+                    if errtoken and not hasattr(errtoken, 'lexer'):
+                        errtoken.lexer = lexer
+                    tok = yacc.call_errorfunc(self.errorfunc, errtoken, self)
+                    if self.errorok:
+                        lookahead = tok
+                        if tok is not None:
+                            ltype = terminals.get(tok.type, unknown)
+                        continue
+                else:
+                    if errtoken:
+                        lineno = getattr(lookahead, 'lineno', 0)
+                        if lineno:
+                            sys.stderr.write(
+                                'yacc: Syntax error at line %d, token=%s\n' %
+                                (lineno, errtoken.type))
+                        else:
+                            sys.stderr.write(
+                                'yacc: Syntax error, token=%s' %
+                                errtoken.type)
+                    else:
+                        sys.stderr.write(
+                            'yacc: Parse error in input. EOF\n')
+                        return
+            else:
+                errorcount = error_count
+
+            if len(statestack) <= 1 and lookahead.type != '$end':
+                lookahead = None
+                state = 0
+                del lookaheadstack[:]
+                continue
+
+            if lookahead.type == '$end':
+                return
+
+            if lookahead.type != 'error':
+                if symstack[-1].type == 'error':
+                    lookahead = None
+                    continue
+                t = YaccSymbol()
+                t.type = 'error'
+                if hasattr(lookahead, 'lineno'):
+                    t.lineno = lookahead.lineno
+                if hasattr(lookahead, 'lexpos'):
+                    t.lexpos = lookahead.lexpos
+                t.value = lookahead
+                lookaheadstack.append(lookahead)
+                lookahead = t
+                ltype = self.error
+            else:
+                symstack.pop()
+                statestack.pop()
+                state = statestack[-1]
@@ -2,6 +2,8 @@ from helpers import Base, SourceElement
 
 
 class PackageStatement(SourceElement):
+    __slots__ = ('name',)
+    _fields = ('name',)
 
     def __init__(self, name, linespan=None, lexspan=None, p=None):
         super(
@@ -10,7 +12,6 @@ class PackageStatement(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name']
         self.name = name
         Base.p(self.name, self)
 
@@ -19,6 +20,8 @@ class PackageStatement(SourceElement):
 
 
 class ImportStatement(SourceElement):
+    __slots__ = ('name',)
+    _fields = ('name',)
 
     def __init__(self, name, linespan=None, lexspan=None, p=None):
         super(
@@ -27,7 +30,6 @@ class ImportStatement(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name']
         self.name = name
         Base.p(self.name, self)
 
@@ -36,6 +38,8 @@ class ImportStatement(SourceElement):
 
 
 class OptionStatement(SourceElement):
+    __slots__ = ('name', 'value')
+    _fields = ('name', 'value')
 
     def __init__(self, name, value, linespan=None, lexspan=None, p=None):
         super(
@@ -44,7 +48,6 @@ class OptionStatement(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'value']
         self.name = name
         Base.p(self.name, self)
         self.value = value
@@ -55,6 +58,8 @@ class OptionStatement(SourceElement):
 
 
 class FieldDirective(SourceElement):
+    __slots__ = ('name', 'value')
+    _fields = ('name', 'value')
 
     def __init__(self, name, value, linespan=None, lexspan=None, p=None):
         super(
@@ -63,7 +68,6 @@ class FieldDirective(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'value']
         self.name = name
         Base.p(self.name, self)
         self.value = value
@@ -77,6 +81,8 @@ class FieldDirective(SourceElement):
 
 
 class FieldType(SourceElement):
+    __slots__ = ('name',)
+    _fields = ('name',)
 
     def __init__(self, name, linespan=None, lexspan=None, p=None):
         super(
@@ -85,7 +91,6 @@ class FieldType(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name']
         self.name = name
         Base.p(self.name, self)
 
@@ -95,6 +100,9 @@ class FieldType(SourceElement):
 
 
 class LinkDefinition(SourceElement):
+    __slots__ = ('link_type', 'src_port', 'name', 'dst_port', 'through',
+                 'reverse_id')
+    _fields = ('link_type', 'src_port', 'name', 'dst_port', 'through')
 
     def __init__(
             self,
@@ -113,8 +121,6 @@ class LinkDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['link_type', 'src_port',
-                         'name', 'dst_port', 'through']
         self.link_type = link_type
         Base.p(self.link_type, self)
 
@@ -138,6 +144,9 @@ class LinkDefinition(SourceElement):
 
 
 class FieldDefinition(SourceElement):
+    __slots__ = ('field_modifier', 'ftype', 'name', 'fieldId', 'policy',
+                 'fieldDirective')
+    _fields = __slots__
 
     def __init__(
             self,
@@ -156,8 +165,6 @@ class FieldDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['field_modifier', 'ftype',
-                         'name', 'fieldId', 'policy', 'fieldDirective']
         self.name = name
         Base.p(self.name, self)
         self.field_modifier = field_modifier
@@ -183,6 +190,8 @@ class FieldDefinition(SourceElement):
 
 
 class EnumFieldDefinition(SourceElement):
+    __slots__ = ('name', 'fieldId')
+    _fields = ('name', 'fieldId')
 
     def __init__(self, name, fieldId, linespan=None, lexspan=None, p=None):
         super(
@@ -191,7 +200,6 @@ class EnumFieldDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'fieldId']
         self.name = name
         Base.p(self.name, self)
         self.fieldId = fieldId
@@ -204,6 +212,8 @@ class EnumFieldDefinition(SourceElement):
 
 
 class ReduceDefinition(SourceElement):
+    __slots__ = ('name', 'body')
+    _fields = ('name', 'body')
 
     def __init__(self, name, body, linespan=None, lexspan=None, p=None):
         super(
@@ -212,7 +222,6 @@ class ReduceDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'body']
         self.name = name
         Base.p(self.name, self)
         self.body = body
@@ -225,6 +234,8 @@ class ReduceDefinition(SourceElement):
 
 
 class MapDefinition(SourceElement):
+    __slots__ = ('name', 'body')
+    _fields = ('name', 'body')
 
     def __init__(self, name, body, linespan=None, lexspan=None, p=None):
         super(
@@ -233,7 +244,6 @@ class MapDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'body']
         self.name = name
         Base.p(self.name, self)
         self.body = body
@@ -246,6 +256,8 @@ class MapDefinition(SourceElement):
 
 
 class PolicyDefinition(SourceElement):
+    __slots__ = ('name', 'body')
+    _fields = ('name', 'body')
 
     def __init__(self, name, body, linespan=None, lexspan=None, p=None):
         super(
@@ -254,7 +266,6 @@ class PolicyDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'body']
         self.name = name
         Base.p(self.name, self)
         self.body = body
@@ -267,6 +278,8 @@ class PolicyDefinition(SourceElement):
 
 
 class EnumDefinition(SourceElement):
+    __slots__ = ('name', 'body')
+    _fields = ('name', 'body')
 
     def __init__(self, name, body, linespan=None, lexspan=None, p=None):
         super(
@@ -275,7 +288,6 @@ class EnumDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'body']
         self.name = name
         Base.p(self.name, self)
         self.body = body
@@ -288,6 +300,8 @@ class EnumDefinition(SourceElement):
 
 
 class LinkSpec(SourceElement):
+    __slots__ = ('link_def', 'field_def')
+    _fields = ('link_def', 'field_def')
 
     def __init__(
             self,
@@ -297,7 +311,6 @@ class LinkSpec(SourceElement):
             lexspan=None,
             p=None):
         super(LinkSpec, self).__init__(linespan=linespan, lexspan=lexspan, p=p)
-        self._fields += ['link_def', 'field_def']
         self.link_def = link_spec
         Base.p(self.link_def, self)
         self.field_def = field_spec
@@ -311,6 +324,8 @@ class LinkSpec(SourceElement):
 
 
 class MessageDefinition(SourceElement):
+    __slots__ = ('name', 'policy', 'bases', 'body')
+    _fields = ('name', 'policy', 'bases', 'body')
 
     def __init__(
             self,
@@ -327,7 +342,6 @@ class MessageDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'policy', 'bases', 'body']
 
         self.name = name
         Base.p(self.name, self)
@@ -368,6 +382,8 @@ class MessageDefinition(SourceElement):
 
 
 class MessageExtension(SourceElement):
+    __slots__ = ('name', 'body')
+    _fields = ('name', 'body')
 
     def __init__(self, name, body, linespan=None, lexspan=None, p=None):
         super(
@@ -376,7 +392,6 @@ class MessageExtension(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'body']
         self.name = name
         Base.p(self.name, self)
         self.body = body
@@ -390,6 +405,8 @@ class MessageExtension(SourceElement):
 
 
 class MethodDefinition(SourceElement):
+    __slots__ = ('name', 'name2', 'name3')
+    _fields = ('name', 'name2', 'name3')
 
     def __init__(
             self,
@@ -405,7 +422,6 @@ class MethodDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'name2', 'name3']
         self.name = name
         Base.p(self.name, self)
         self.name2 = name2
@@ -422,6 +438,8 @@ class MethodDefinition(SourceElement):
 
 
 class ServiceDefinition(SourceElement):
+    __slots__ = ('name', 'body')
+    _fields = ('name', 'body')
 
     def __init__(self, name, body, linespan=None, lexspan=None, p=None):
         super(
@@ -430,7 +448,6 @@ class ServiceDefinition(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['name', 'body']
         self.name = name
         Base.p(self.name, self)
         self.body = body
@@ -444,10 +461,12 @@ class ServiceDefinition(SourceElement):
 
 
 class ExtensionsMax(SourceElement):
-    pass
+    __slots__ = ()
 
 
 class ExtensionsDirective(SourceElement):
+    __slots__ = ('fromVal', 'toVal')
+    _fields = ('fromVal', 'toVal')
 
     def __init__(self, fromVal, toVal, linespan=None, lexspan=None, p=None):
         super(
@@ -456,7 +475,6 @@ class ExtensionsDirective(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['fromVal', 'toVal']
         self.fromVal = fromVal
         Base.p(self.fromVal, self)
         self.toVal = toVal
@@ -470,10 +488,11 @@ class ExtensionsDirective(SourceElement):
 
 
 class Literal(SourceElement):
+    __slots__ = ('value',)
+    _fields = ('value',)
 
     def __init__(self, value, linespan=None, lexspan=None, p=None):
         super(Literal, self).__init__(linespan=linespan, lexspan=lexspan, p=p)
-        self._fields += ['value']
         self.value = value
 
     def accept(self, visitor):
@@ -481,10 +500,11 @@ class Literal(SourceElement):
 
 
 class Name(SourceElement):
+    __slots__ = ('value',)
+    _fields = ('value',)
 
     def __init__(self, value, linespan=None, lexspan=None, p=None):
         super(Name, self).__init__(linespan=linespan, lexspan=lexspan, p=p)
-        self._fields += ['value']
         self.value = value
         self.deriveLex()
 
@@ -506,17 +526,19 @@ class Name(SourceElement):
 
 
 class DotName(Name):
-    elements = []
+    __slots__ = ('elements',)
+    _fields = Name._fields + ('elements',)
 
     def __init__(self, elements, linespan=None, lexspan=None, p=None):
+        # Set before Name.__init__, whose deriveLex() call reads elements.
+        self.elements = elements
         super(DotName, self).__init__(
             '.'.join([str(x) for x in elements]), linespan=linespan, lexspan=lexspan, p=p)
-        self._fields += ['elements']
-        self.elements = elements
-        self.deriveLex()
 
     def deriveLex(self):
         if isinstance(self.elements, list) and len(self.elements) > 0:
+            if not hasattr(self.elements[0], 'lexspan'):
+                return  # plain strings, parsed without spans
             self.lexspan = (min([x.lexspan[0] for x in self.elements if x.lexspan[0] != 0]), max(
                 [x.lexspan[1] for x in self.elements if x.lexspan[1] != 0]))
             self.linespan = (min([x.linespan[0] for x in self.elements if x.linespan[0] != 0]), max(
@@ -532,6 +554,10 @@ class DotName(Name):
 
 
 class ProtoFile(SourceElement):
+    __slots__ = ('body', 'lines', 'diagnostics', 'errors')
+    _fields = ('body',)
+    _uncompared = SourceElement._uncompared + \
+        ('lines', 'diagnostics', 'errors')
 
     def __init__(self, body, linespan=None, lexspan=None, p=None):
         super(
@@ -540,9 +566,14 @@ class ProtoFile(SourceElement):
             linespan=linespan,
             lexspan=lexspan,
             p=p)
-        self._fields += ['body']
         self.body = body
         Base.p(self.body, self)
+        # Set once parsing is done: the source.LineTable of the parsed text,
+        # the helpers.Diagnostic for every lexical error skipped and the
+        # ParsingError for every syntax error a recovering parse got past.
+        self.lines = None
+        self.diagnostics = None
+        self.errors = None
 
     def accept(self, visitor):
         if visitor.visit_Proto(self):
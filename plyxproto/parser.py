@@ -4,8 +4,6 @@ __copyright__ = "Copyright (C) 2014 Dusan (ph4r05) Klinec"
 __license__ = "Apache License, Version 2.0"
 __version__ = "1.0"
 
-import ply.lex as lex
-import ply.yacc as yacc
 
 from .model import (
     DotName,
@@ -33,9 +31,23 @@ from .model import (
     ServiceDefinition,
 )
 
-from helpers import LexHelper, LU
+from helpers import (
+    LexHelper,
+    LU,
+    NameTable,
+    close_delimited,
+    find_block_comment_end,
+    illegal_chars,
+    intern_name,
+    skip_illegal,
+)
 from logicparser import FOLParser, FOLLexer, FOLParsingError
+from . import tables
+import ply.yacc as yacc
+from .source import LineTable, read_source, string_types
 import ast
+import os
+import threading
 
 
 class PythonError(Exception):
@@ -44,9 +56,25 @@ class PythonError(Exception):
 
 class ParsingError(Exception):
 
-    def __init__(self, message, error_range):
+    # errors lists every syntax error found by a recovering parse (this one
+    # included) when the parse could not produce a tree.
+    def __init__(self, message, error_range, lines=None, diagnostics=None,
+                 errors=None):
         super(ParsingError, self).__init__(message)
         self.error_range = error_range
+        self.lines = lines
+        self.diagnostics = diagnostics
+        self.errors = errors
+
+    def __reduce__(self):
+        return (self.__class__, (self.args[0], self.error_range, self.lines,
+                                 self.diagnostics, self.errors))
+
+    def position(self):
+        '''(line, column) of the offending token, if the source is known.'''
+        if self.lines is None:
+            return None
+        return self.lines.position(self.error_range[1])
 
 
 class ProtobufLexer(object):
@@ -103,9 +131,10 @@ class ProtobufLexer(object):
         'STARTTOKEN'
     ] + [k.upper() for k in keywords]
 
+    # Matches '< (.|\n)*? [^-]>': the first '>' not preceded by '-'.
     def t_POLICYBODY(self, t):
-        r'< (.|\n)*? [^-]>'
-        t.lexer.lineno += t.value.count('\n')
+        r'<'
+        close_delimited(t, find_policy_end, '<')
         return t
 
     literals = '()+-*/=?:,.^|&~!=[]{};<>@%'
@@ -116,8 +145,9 @@ class ProtobufLexer(object):
     t_ignore_LINE_COMMENT = '//.*'
 
     def t_BLOCK_COMMENT(self, t):
-        r'/\*(.|\n)*?\*/'
-        t.lexer.lineno += t.value.count('\n')
+        r'/\*'
+        if not close_delimited(t, find_block_comment_end, 'SLASH'):
+            return t
 
     t_LBRACE = '{'
     t_RBRACE = '}'
@@ -142,6 +172,7 @@ class ProtobufLexer(object):
         if t.value in ProtobufLexer.keywords:
             # print "type: %s val %s t %s" % (t.type, t.value, t)
             t.type = t.value.upper()
+        t.value = intern_name(t.lexer, t.value)
         return t
 
     def t_newline(self, t):
@@ -153,9 +184,17 @@ class ProtobufLexer(object):
         t.lexer.lineno += len(t.value) / 2
 
     def t_error(self, t):
-        print("Illegal character '{}' ({}) in line {}".format(
-            t.value[0], hex(ord(t.value[0])), t.lexer.lineno))
-        t.lexer.skip(1)
+        skip_illegal(t, ProtobufLexer.illegal)
+
+
+ProtobufLexer.illegal = illegal_chars(ProtobufLexer)
+
+
+def find_policy_end(data, pos):
+    end = data.find('>', pos + 1)
+    while end != -1 and data[end - 1] == '-':
+        end = data.find('>', end + 1)
+    return end if end == -1 else end + 1
 
 
 def srcPort(x):
@@ -168,13 +207,35 @@ def srcPort(x):
 class ProtobufParser(object):
     tokens = ProtobufLexer.tokens
     offset = 0
-    lh = LexHelper()
-    fol_lexer = lex.lex(module=FOLLexer())  # , optimize=1)
-    fol_parser = yacc.yacc(
-        module=FOLParser(),
-        start='goal',
-        outputdir='/tmp',
-        debug=0)
+    # Syntax errors are collected here instead of raised when it is a list.
+    errors = None
+    # (lineno, lexpos, 0) just past the input, for errors at end of input.
+    end = (0, 0, 0)
+    _fol = None
+    _fol_lock = threading.Lock()
+
+    def __init__(self):
+        self.lh = LexHelper()
+        self.fol_lexer = None
+        self.fol_parser = None
+
+    # The policy sub-parser is only needed for files with policy statements,
+    # so its tables are built on first use rather than at import time.
+    @classmethod
+    def fol_grammar(cls):
+        if cls._fol is None:
+            with cls._fol_lock:
+                if cls._fol is None:
+                    cls._fol = (tables.build_lexer(FOLLexer(), 'fol'),
+                                tables.build_table(FOLParser(), 'goal', 'fol'))
+        return cls._fol
+
+    def fol(self):
+        if self.fol_parser is None:
+            lexer, table = self.fol_grammar()
+            self.fol_lexer = lexer.clone()
+            self.fol_parser = tables.make_parser(table, FOLParser())
+        return self.fol_lexer, self.fol_parser
 
     def setOffset(self, of):
         self.offset = of
@@ -278,10 +339,12 @@ class ProtobufParser(object):
                | csv COMMA dotname'''
 
         if len(p) == 2:
-            p[0] = [LU(p, 1)]
+            p[0] = [LU.wrap(p, 1)]
         else:
-            p[0] = p[1] + [LU(p, 3)]
+            p[1].append(LU.wrap(p, 3))
+            p[0] = p[1]
 
+    @yacc.passthrough
     def p_field_directive_times(self, p):
         '''field_directive_times : field_directive_plus'''
         p[0] = p[1]
@@ -294,17 +357,19 @@ class ProtobufParser(object):
         '''field_directive_plus : field_directive
                                | field_directive_plus COMMA field_directive'''
         if len(p) == 2:
-            p[0] = [LU(p, 1)]
+            p[0] = [LU.wrap(p, 1)]
         else:
-            p[0] = p[1] + [LU(p, 3)]
+            p[1].append(LU.wrap(p, 3))
+            p[0] = p[1]
 
     def p_dotname(self, p):
         '''dotname : NAME
                    | dotname DOT NAME'''
         if len(p) == 2:
-            p[0] = [LU(p, 1)]
+            p[0] = [LU.wrap(p, 1)]
         else:
-            p[0] = p[1] + [LU(p, 3)]
+            p[1].append(LU.wrap(p, 3))
+            p[0] = p[1]
 
     # Hack for cases when there is a field named 'message' or 'max'
     def p_fieldName(self, p):
@@ -324,6 +389,7 @@ class ProtobufParser(object):
     def p_field_type2(self, p):
         '''field_type : dotname'''
         p[0] = DotName(LU.i(p, 1))
+        p[0].value = intern_name(p.lexer, p[0].value)
         self.lh.set_parse_object(p[0], p)
         p[0].deriveLex()
 
@@ -416,6 +482,7 @@ class ProtobufParser(object):
         p[0] = EnumFieldDefinition(LU.i(p, 1), LU.i(p, 3))
         self.lh.set_parse_object(p[0], p)
 
+    @yacc.passthrough
     def p_enum_body_part(self, p):
         '''enum_body_part : enum_field
                           | option_directive'''
@@ -427,49 +494,94 @@ class ProtobufParser(object):
         if len(p) == 2:
             p[0] = [p[1]]
         else:
-            p[0] = p[1] + [p[2]]
+            p[1].append(p[2])
+            p[0] = p[1]
 
     def p_enum_body_opt(self, p):
         '''enum_body_opt : empty'''
         p[0] = []
 
+    @yacc.passthrough
     def p_enum_body_opt2(self, p):
         '''enum_body_opt : enum_body'''
         p[0] = p[1]
 
+    # The lambda of a map or reduce definition, p[3] without its delimiters.
+    # Text that is not Python at all is a syntax error of the source, raised
+    # or, in a recovering parse, recorded; the definition is then kept without
+    # a body (None). The SyntaxError of ast.parse must not leave the rule
+    # action: PLY would take it for a request to start error recovery,
+    # silently, without calling p_error.
+    def lambda_body(self, p, kind):
+        ltxt = p[3].lstrip('<').rstrip('>')
+        try:
+            body = ast.parse(ltxt).body
+        except (SyntaxError, TypeError, ValueError) as e:
+            lineno = getattr(e, 'lineno', None) or 1
+            column = (getattr(e, 'offset', None) or 1) - 1
+            lines = ltxt.split('\n')
+            offset = sum(len(line) + 1 for line in lines[:lineno - 1])
+            offset = min(offset + column, len(ltxt))
+            start = len(p[3]) - len(p[3].lstrip('<'))
+            error = ParsingError(
+                "Python syntax error in %s %s" % (kind, p[2]),
+                (p.lineno(3) + lineno - 1, p.lexpos(3) + start + offset, 1))
+            if self.errors is None:
+                raise error
+            self.errors.append(error)
+            return None
+        if not body or not isinstance(body[0], ast.Expr):
+            raise PythonError("%s operator needs to be an expression" % kind)
+        elif not isinstance(body[0].value, ast.Lambda):
+            raise PythonError("%s operator needs to be a lambda" % kind)
+        return ltxt
+
+    # The reduce, map and policy actions parse their bodies and can fail, so
+    # they are marked @yacc.needs_lookahead: the parser must not reduce by
+    # them before checking the next token, or their error would be reported
+    # ahead of a syntax error in that token. Any other rule whose action can
+    # raise or record an error needs the mark too.
+    @yacc.needs_lookahead
     def p_reduce_definition(self, p):
         '''reduce_definition : REDUCE NAME POLICYBODY'''
-        ltxt = p[3].lstrip('<').rstrip('>')
-        l = ast.parse(ltxt).body[0]
-        if not isinstance(l, ast.Expr):
-            raise PythonError("reduce operator needs to be an expression")
-        elif not isinstance(l.value, ast.Lambda):
-            raise PythonError("reduce operator needs to be a lambda")
-
+        ltxt = self.lambda_body(p, 'reduce')
         p[0] = ReduceDefinition(Name(LU.i(p, 2)), ltxt)
         self.lh.set_parse_object(p[0], p)
 
+    @yacc.needs_lookahead
     def p_map_definition(self, p):
         '''map_definition : MAP NAME POLICYBODY'''
-        ltxt = p[3].lstrip('<').rstrip('>')
-        l = ast.parse(ltxt).body[0]
-        if not isinstance(l, ast.Expr):
-            raise PythonError("map operator needs to be an expression")
-        elif not isinstance(l.value, ast.Lambda):
-            raise PythonError("map operator needs to be a lambda")
-
+        ltxt = self.lambda_body(p, 'map')
         p[0] = MapDefinition(Name(LU.i(p, 2)), ltxt)
         self.lh.set_parse_object(p[0], p)
 
+    @yacc.needs_lookahead
     def p_policy_definition(self, p):
         '''policy_definition : POLICY NAME POLICYBODY'''
+        fol_lexer, fol_parser = self.fol()
+        fol_lexer.lineno = 1
+        diagnostics = getattr(p.lexer, 'diagnostics', None)
+        fol_lexer.diagnostics = None if diagnostics is None else []
+        fol_lexer.names = getattr(p.lexer, 'names', None)
         try:
-            fol = self.fol_parser.parse(p[3], lexer=self.fol_lexer)
+            fol = fol_parser.parse(p[3], lexer=fol_lexer)
         except FOLParsingError as e:
+            if e.error_range is None:
+                e.error_range = (fol_lexer.lineno, len(p[3]), 0)
             lineno, lexpos, length = e.error_range
-            raise ParsingError(
+            error = ParsingError(
                 "Policy parsing error in policy %s" %
-                p[2], (p.lineno(3) + lineno, lexpos + p.lexpos(3), length))
+                p[2], (p.lineno(3) + lineno - 1, lexpos + p.lexpos(3), length))
+            if self.errors is None:
+                raise error
+            # A recovering parse keeps the policy, without a body.
+            self.errors.append(error)
+            fol = None
+        finally:
+            for d in fol_lexer.diagnostics or ():
+                diagnostics.append(d._replace(
+                    lexpos=d.lexpos + p.lexpos(3),
+                    lineno=d.lineno + p.lineno(3) - 1))
         p[0] = PolicyDefinition(Name(LU.i(p, 2)), fol)
         self.lh.set_parse_object(p[0], p)
 
@@ -501,6 +613,7 @@ class ProtobufParser(object):
         p[0] = MessageExtension(Name(LU.i(p, 2)), LU.i(p, 4))
         self.lh.set_parse_object(p[0], p)
 
+    @yacc.passthrough
     def p_message_body_part(self, p):
         '''message_body_part : field_definition
                            | link_definition
@@ -526,7 +639,15 @@ class ProtobufParser(object):
         if len(p) == 2:
             p[0] = [p[1]]
         else:
-            p[0] = p[1] + [p[2]]
+            p[1].append(p[2])
+            p[0] = p[1]
+
+    # Error recovery: a broken field or other body part is dropped up to the
+    # next ';' and the body goes on after it.
+    def p_message_body_error(self, p):
+        '''message_body : message_body error SEMI'''
+        self.check_recovering(p)
+        p[0] = p[1]
 
     # Root of the message declaration.
     # message_definition = MESSAGE_ - ident("messageId") + LBRACE + message_body("body") + RBRACE
@@ -565,7 +686,8 @@ class ProtobufParser(object):
         if len(p) == 2:
             p[0] = [p[1]]
         else:
-            p[0] = p[1] + [p[2]]
+            p[1].append(p[2])
+            p[0] = p[1]
 
     # service_definition ::= 'service' ident '{' method_definition* '}'
     # service_definition = SERVICE_ - ident("serviceName") + LBRACE + ZeroOrMore(Group(method_definition)) + RBRACE
@@ -590,11 +712,11 @@ class ProtobufParser(object):
         '''option_rvalue : NUM
                          | TRUE
                          | FALSE'''
-        p[0] = LU(p, 1)
+        p[0] = LU.wrap(p, 1)
 
     def p_option_rvalue2(self, p):
         '''option_rvalue : STRING_LITERAL'''
-        p[0] = Literal(LU(p, 1))
+        p[0] = Literal(LU.wrap(p, 1))
 
     def p_option_rvalue3(self, p):
         '''option_rvalue : NAME'''
@@ -607,6 +729,7 @@ class ProtobufParser(object):
         self.lh.set_parse_object(p[0], p)
 
     # topLevelStatement = Group(message_definition | message_extension | enum_definition | service_definition | import_directive | option_directive | package_definition)
+    @yacc.passthrough
     def p_topLevel(self, p):
         '''topLevel : message_definition
                     | message_extension
@@ -626,7 +749,16 @@ class ProtobufParser(object):
         if len(p) == 2:
             p[0] = [p[1]]
         else:
-            p[0] = p[1] + [p[2]]
+            p[1].append(p[2])
+            p[0] = p[1]
+
+    # Error recovery: a broken top-level statement is dropped up to the next
+    # ';' or '}' and parsing goes on with the statement after it.
+    def p_statements_error(self, p):
+        '''statements : statements error SEMI
+                      | statements error RBRACE'''
+        self.check_recovering(p)
+        p[0] = p[1]
 
     def p_statements(self, p):
         '''statements : empty'''
@@ -643,42 +775,311 @@ class ProtobufParser(object):
         '''goal : STARTTOKEN protofile'''
         p[0] = p[2]
 
+    # The error productions above only take part in a recovering parse.
+    # Otherwise p_error raises before PLY gets to shift an error token, so a
+    # reduction by one of them means the error came by another way (a rule
+    # action raising SyntaxError, which PLY handles without p_error). It is
+    # raised here rather than swallowed.
+    def check_recovering(self, p):
+        if self.errors is None:
+            token = p[2] if hasattr(p[2], 'lexpos') else p.slice[3]
+            raise self.syntax_error(token)
+
+    def syntax_error(self, token):
+        if token is None:
+            return ParsingError("Parsing Error: unexpected end of input",
+                                self.end)
+        return ParsingError("Parsing Error",
+                            (token.lineno, token.lexpos, len(token.value)))
+
     def p_error(self, p):
-        raise ParsingError("Parsing Error", (p.lineno, p.lexpos, len(p.value)))
+        error = self.syntax_error(p)
+        if self.errors is None:
+            raise error
+        self.errors.append(error)
+
+
+class ProtobufGrammar(object):
+    '''
+    The lexer and LALR tables for xproto. A grammar is never modified after
+    it is built, so one instance can be shared by any number of threads;
+    each parse runs in its own ParseSession.
+
+    backend selects the lexer: 'ply' (the PLY lexer built from
+    ProtobufLexer) or 'scanner' (plyxproto.scanner.XprotoScanner, a faster
+    hand-written scanner producing the same tokens).
+
+    engine selects the parser: 'generated' (a parser generated for this
+    grammar, see plyxproto.lrgen) or 'ply' (PLY's LRParser). Both build the
+    same trees.
+    '''
+
+    def __init__(self, cachedir=None, backend='ply', engine='generated'):
+        self.backend = backend
+        self.engine = engine
+        if backend == 'ply':
+            self.lexer = tables.build_lexer(ProtobufLexer(), 'xproto')
+        elif backend == 'scanner':
+            from .scanner import XprotoScanner
+            self.lexer = XprotoScanner()
+        else:
+            raise ValueError('unknown lexer backend %r' % (backend,))
+        rules = ProtobufParser()
+        self.table = tables.build_table(rules, 'goal', 'xproto',
+                                        outputdir=cachedir)
+        if engine == 'generated':
+            self.parser_class = tables.build_generated(
+                rules, 'goal', 'xproto', self.table, outputdir=cachedir)
+        elif engine == 'ply':
+            self.parser_class = yacc.LRParser
+        else:
+            raise ValueError('unknown parser engine %r' % (engine,))
+
+    def session(self, lean=False, names=None):
+        return ParseSession(self, lean, names)
+
+
+class ParseSession(object):
+    '''
+    Per-parse state: a clone of the grammar's lexer, a parser bound to a
+    fresh ProtobufParser (and so its own LexHelper and policy sub-parser).
+    A lean session builds trees that hold no parser objects. With a
+    helpers.NameTable, identifiers in the trees are interned in it.
+
+    Parsing with spans=False builds a structure-only tree: the same node
+    types, with plain strings where token values would be wrapped in LU
+    and no lexspan or linespan on any node.
+
+    Parsing with recover=True does not stop at the first syntax error. The
+    parser skips to the next ';' (or '}' between top-level statements) and
+    goes on; the tree it returns lacks the broken parts and lists every
+    error in its errors attribute. If no tree can be built at all, the
+    first error is raised, with the whole list in its errors attribute.
+    '''
+
+    def __init__(self, grammar, lean=False, names=None):
+        self.grammar = grammar
+        self.lexer = grammar.lexer.clone()
+        self.lexer.names = names
+        self.rules = ProtobufParser()
+        self.parser = tables.make_parser(grammar.table, self.rules,
+                                         grammar.parser_class)
+        self.parser.lean = lean
+
+    def parse(self, code, debug=0, lineno=1, prefix='+', spans=True,
+              recover=False):
+        self.lexer.lineno = lineno
+        self.parser.offset = len(prefix)
+        self.parser.spans = spans
+        lines = LineTable(code, lineno, len(prefix))
+        return self._parse(lines, len(code), [], recover, prefix + code,
+                           lexer=self.lexer, debug=debug)
+
+    def parse_tokens(self, tokens, debug=0, prefix='+', spans=True,
+                     recover=False):
+        self.parser.spans = spans
+        lexer = self.lexer.clone()
+        lexer.lineno = tokens.start_lineno
+        lexer.input(prefix)
+        offset = len(prefix)
+        self.parser.offset = offset
+        lines = LineTable(tokens.data, tokens.start_lineno, offset)
+        diagnostics = [d._replace(lexpos=d.lexpos + offset)
+                       for d in tokens.diagnostics]
+        return self._parse(
+            lines, len(tokens.data), diagnostics, recover,
+            lexer=self.lexer, debug=debug,
+            tokenfunc=tokens.tokenfunc(list(lexer), offset,
+                                       getattr(self.lexer, 'names', None)))
+
+    def parse_region(self, text, start, end, lines, lineno, spans=True):
+        '''
+        Parse the top-level statements in text[start:end], where text is a
+        whole source behind its prefix and lines its LineTable. Tokens keep
+        their positions in text; lineno is the line at start. Returns the
+        tree and the lexpos of the first token at or past end (len(text) if
+        there is none): unless that is end, the last token or statement ran
+        on past the region.
+
+        Errors are raised as by parse(), except those raised once the
+        tokens were cut off at end, which a parse of the whole text need
+        not run into: the tree is None then.
+        '''
+        lexer = self.lexer
+        lexer.input(text)
+        lexer.lineno = lines.lineno
+        lead = [lexer.token()]
+        lexer.lineno = lineno
+        lexer.lexpos = start
+        self.parser.offset = lines.offset
+        self.parser.spans = spans
+        stop = [len(text)]
+        cut = [False]
+
+        def next_token():
+            if lead:
+                return lead.pop()
+            t = lexer.token()
+            if t is not None and t.lexpos >= end:
+                stop[0] = t.lexpos
+                cut[0] = True
+                return None
+            return t
+
+        try:
+            tree = self._parse(lines, len(text) - lines.offset, [], False,
+                               lexer=lexer, tokenfunc=next_token)
+        except (ParsingError, PythonError):
+            if cut[0]:
+                return None, stop[0]
+            raise
+        return tree, stop[0]
+
+    # The tree, or the ParsingError, gets the line table of the source and
+    # the lexical errors skipped on the way, in the lexpos coordinates of the
+    # parse (prefix included). size is the length of the source text.
+    def _parse(self, lines, size, diagnostics, recover, *args, **kwargs):
+        errors = [] if recover else None
+        self.lexer.diagnostics = diagnostics
+        self.rules.errors = errors
+        self.rules.end = (lines.lineno + len(lines) - 1, lines.offset + size,
+                          0)
+        try:
+            tree = self.parser.parse(*args, **kwargs)
+            if tree is None:
+                # PLY gives up without a tree when recovery runs into the
+                # end of the input.
+                if errors:
+                    raise errors[0]
+                error = ParsingError("Parsing Error: no parse tree",
+                                     self.rules.end)
+                if errors is not None:
+                    errors.append(error)
+                raise error
+        except ParsingError as e:
+            e.lines = lines
+            e.diagnostics = diagnostics
+            e.errors = errors
+            raise
+        finally:
+            self.lexer.diagnostics = None
+            self.rules.errors = None
+        for e in errors or ():
+            e.lines = lines
+        tree.lines = lines
+        tree.diagnostics = diagnostics
+        tree.errors = errors or []
+        return tree
 
 
 class ProtobufAnalyzer(object):
 
-    def __init__(self):
-        self.lexer = lex.lex(module=ProtobufLexer())
-        self.parser = yacc.yacc(
-            module=ProtobufParser(),
-            start='goal',
-            debug=0,
-            outputdir='/tmp')
+    # Every analyzer interns identifiers in a NameTable, so the trees it
+    # returns share one string per distinct name. Pass the same table to
+    # several analyzers to share it between them, or names=False to turn
+    # interning off.
+    #
+    # cache is a cache.DiskCache or cache.MemoryCache (or anything with
+    # their key, get and put methods); parse_string and parse_file look
+    # trees up in it first. A cache with a file_key method, like
+    # MemoryCache, is also asked whether a path has changed before
+    # parse_file reads it.
+    def __init__(self, cachedir=None, grammar=None, lean=False,
+                 backend='ply', names=None, cache=None, engine='generated'):
+        self.grammar = grammar or ProtobufGrammar(cachedir, backend, engine)
+        self.lean = lean
+        self.cache = cache
+        if names is None:
+            names = NameTable()
+        elif names is False:
+            names = None
+        self.names = names
+        self.local = threading.local()
+
+    # Sessions are reused within a thread, never shared between threads.
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.grammar.session(
+                self.lean, self.names)
+        return session
+
+    def iter_tokens(self, code, lineno=1):
+        lexer = self.grammar.lexer.clone()
+        lexer.lineno = lineno
+        lexer.input(code)
+        return iter(lexer)
+
+    def tokenize_buffer(self, code, lineno=1):
+        '''
+        Tokenize code into a TokenBuffer, which stores the stream in arrays
+        and can be handed to parse_tokens().
+        '''
+        from .tokenbuffer import TokenBuffer
+        return TokenBuffer.from_lexer(self.grammar.lexer, code, lineno)
 
     def tokenize_string(self, code):
-        self.lexer.input(code)
-        for token in self.lexer:
+        for token in self.iter_tokens(code):
             print(token)
 
-    def tokenize_file(self, _file):
-        if isinstance(_file, str):
-            _file = file(_file)
-        content = ''
-        for line in _file:
-            content += line
-        return self.tokenize_string(content)
-
-    def parse_string(self, code, debug=0, lineno=1, prefix='+'):
-        self.lexer.lineno = lineno
-        self.parser.offset = len(prefix)
-        return self.parser.parse(prefix + code, lexer=self.lexer, debug=debug)
-
-    def parse_file(self, _file, debug=0):
-        if isinstance(_file, str):
-            _file = file(_file)
-        content = ''
-        for line in _file:
-            content += line
-        return self.parse_string(content, debug=debug)
+    def tokenize_file(self, _file, encoding=None):
+        return self.tokenize_string(read_source(_file, encoding))
+
+    # spans=False skips all span bookkeeping and recover=True collects every
+    # syntax error instead of raising the first; see ParseSession.
+    def parse_string(self, code, debug=0, lineno=1, prefix='+', spans=True,
+                     recover=False):
+        cache = self.cache
+        if cache is None or debug:
+            return self.session().parse(
+                code, debug=debug, lineno=lineno, prefix=prefix, spans=spans,
+                recover=recover)
+        return self._parse_cached(
+            cache.key(code, *self._options(lineno, prefix, spans, recover)),
+            code, lineno, prefix, spans, recover)
+
+    # The options a cached tree is kept under: besides those of the parse,
+    # everything else about this analyzer that shapes its trees.
+    def _options(self, *options):
+        return (self.grammar.backend, self.grammar.engine,
+                self.lean) + options
+
+    def _parse_cached(self, key, code, lineno, prefix, spans, recover):
+        tree = self.cache.get(key)
+        if tree is None:
+            tree = self.session().parse(
+                code, lineno=lineno, prefix=prefix, spans=spans,
+                recover=recover)
+            self.cache.put(key, tree)
+        return tree
+
+    def parse_tokens(self, tokens, debug=0, spans=True, recover=False):
+        return self.session().parse_tokens(tokens, debug=debug, spans=spans,
+                                           recover=recover)
+
+    # _file may be a path, a file object or a buffer; see source.read_source.
+    def parse_file(self, _file, debug=0, encoding=None, spans=True,
+                   recover=False):
+        cache = self.cache
+        if cache is None or debug or not isinstance(_file, string_types) or \
+                not hasattr(cache, 'file_key'):
+            return self.parse_string(read_source(_file, encoding),
+                                     debug=debug, spans=spans, recover=recover)
+        st = os.stat(_file)
+        stamp = (st.st_mtime, st.st_size)
+        options = self._options(encoding, spans, recover)
+        known = cache.file_key(_file, stamp, options)
+        if known is not None:
+            tree = cache.get(known)
+            if tree is not None:
+                return tree
+        code = read_source(_file, encoding)
+        key = cache.key(code, *self._options(1, '+', spans, recover))
+        if key == known:
+            # Already looked up, and dropped from the cache since.
+            tree = self.session().parse(code, spans=spans, recover=recover)
+            cache.put(key, tree)
+        else:
+            tree = self._parse_cached(key, code, 1, '+', spans, recover)
+        cache.file_key(_file, stamp, options, key)
+        return tree
@@ -0,0 +1,219 @@
+# A hand-written scanner for the xproto token set.
+#
+# XprotoScanner produces exactly the token stream of the PLY lexer built from
+# ProtobufLexer (same types, values, line numbers and positions, same handling
+# of illegal characters) and has the same interface as far as the parser is
+# concerned: input(), token(), lineno, lexpos, clone() and iteration. Instead
+# of trying a master regex at every position it dispatches on the first
+# character of each token, looks keywords up in a dict and counts newlines in
+# place.
+
+import copy
+import re
+
+from ply.lex import LexError, LexToken
+
+from .helpers import find_block_comment_end
+from .parser import ProtobufLexer, find_policy_end
+
+KEYWORDS = dict((k, k.upper()) for k in ProtobufLexer.keywords)
+
+NAME = re.compile(r'[A-Za-z_$][A-Za-z0-9_+$]*')
+NUM = re.compile(r'[+-]?[0-9]+(\.[0-9]+)?')
+STRING_LITERAL = re.compile(r'"(?:[^"\\\n]|\\.)*"')
+NEWLINES = re.compile(r'\n+')
+CRLFS = re.compile(r'(?:\r\n)+')
+
+# Character classes, keyed by the first character of a token.
+(_IGNORE, _NAME, _NUM, _SIGN, _MINUS, _STRING, _SLASH, _LT, _NEWLINE, _CR,
+ _COLON, _SIMPLE, _LITERAL) = range(13)
+
+SIMPLE = {
+    '{': 'LBRACE', '}': 'RBRACE', '[': 'LBRACK', ']': 'RBRACK',
+    '(': 'LPAR', ')': 'RPAR', '=': 'EQ', ';': 'SEMI', ',': 'COMMA',
+    '.': 'DOT',
+}
+
+CLASSES = {}
+for c in ' \t\f':
+    CLASSES[c] = _IGNORE
+for c in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_$':
+    CLASSES[c] = _NAME
+for c in '0123456789':
+    CLASSES[c] = _NUM
+for c in ProtobufLexer.literals:
+    CLASSES[c] = _LITERAL
+for c in SIMPLE:
+    CLASSES[c] = _SIMPLE
+CLASSES.update({'+': _SIGN, '-': _MINUS, '"': _STRING, '/': _SLASH,
+                '<': _LT, '\n': _NEWLINE, '\r': _CR, ':': _COLON})
+
+
+class Token(object):
+    __slots__ = ('type', 'value', 'lineno', 'lexpos', 'lexer')
+
+    def __init__(self, type, value, lineno, lexpos):
+        self.type = type
+        self.value = value
+        self.lineno = lineno
+        self.lexpos = lexpos
+
+    __str__ = LexToken.__str__.__func__
+    __repr__ = LexToken.__repr__.__func__
+
+
+class XprotoScanner(object):
+
+    def __init__(self):
+        self.lexdata = ''
+        self.lexpos = 0
+        self.lexlen = 0
+        self.lineno = 1
+        self.rules = ProtobufLexer()
+        self.no_policy_end = None
+        self.no_comment_end = None
+        self.names = None
+
+    def clone(self):
+        return copy.copy(self)
+
+    def input(self, data):
+        self.lexdata = data
+        self.lexpos = 0
+        self.lexlen = len(data)
+        self.no_policy_end = None
+        self.no_comment_end = None
+
+    def skip(self, n):
+        self.lexpos += n
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        t = self.token()
+        if t is None:
+            raise StopIteration
+        return t
+
+    __next__ = next
+
+    def token(self):
+        data = self.lexdata
+        pos = self.lexpos
+        end = self.lexlen
+        classes = CLASSES
+        while pos < end:
+            c = data[pos]
+            kind = classes.get(c)
+
+            if kind == _IGNORE:
+                pos += 1
+                continue
+
+            if kind == _NAME:
+                value = NAME.match(data, pos).group()
+                self.lexpos = pos + len(value)
+                if self.names is not None:
+                    value = self.names.intern(value)
+                return Token(KEYWORDS.get(value, 'NAME'), value,
+                             self.lineno, pos)
+
+            if kind == _SIMPLE:
+                self.lexpos = pos + 1
+                return Token(SIMPLE[c], c, self.lineno, pos)
+
+            if kind == _NEWLINE:
+                m = NEWLINES.match(data, pos)
+                self.lineno += m.end() - pos
+                pos = m.end()
+                continue
+
+            if kind == _NUM or kind == _SIGN or kind == _MINUS:
+                m = NUM.match(data, pos)
+                if m is not None:
+                    self.lexpos = m.end()
+                    return Token('NUM', m.group(), self.lineno, pos)
+                if kind == _SIGN:
+                    self.lexpos = pos + 1
+                    return Token('STARTTOKEN', c, self.lineno, pos)
+                if kind == _MINUS:
+                    if data.startswith('->', pos):
+                        self.lexpos = pos + 2
+                        return Token('ARROW', '->', self.lineno, pos)
+                    self.lexpos = pos + 1
+                    return Token(c, c, self.lineno, pos)
+
+            elif kind == _STRING:
+                m = STRING_LITERAL.match(data, pos)
+                if m is not None:
+                    self.lexpos = m.end()
+                    return Token('STRING_LITERAL', m.group(), self.lineno,
+                                 pos)
+
+            elif kind == _COLON:
+                if data.startswith('::', pos):
+                    self.lexpos = pos + 2
+                    return Token('DOUBLECOLON', '::', self.lineno, pos)
+                self.lexpos = pos + 1
+                return Token('COLON', c, self.lineno, pos)
+
+            elif kind == _SLASH:
+                if data.startswith('/*', pos):
+                    stop = -1
+                    if self.no_comment_end is None or \
+                            pos < self.no_comment_end:
+                        stop = find_block_comment_end(data, pos + 2)
+                        if stop == -1:
+                            self.no_comment_end = pos
+                    if stop != -1:
+                        self.lineno += data.count('\n', pos, stop)
+                        pos = stop
+                        continue
+                elif data.startswith('//', pos):
+                    stop = data.find('\n', pos)
+                    pos = end if stop == -1 else stop
+                    continue
+                self.lexpos = pos + 1
+                return Token('SLASH', c, self.lineno, pos)
+
+            elif kind == _LT:
+                stop = -1
+                if self.no_policy_end is None or pos < self.no_policy_end:
+                    stop = find_policy_end(data, pos + 1)
+                    if stop == -1:
+                        self.no_policy_end = pos
+                if stop == -1:
+                    self.lexpos = pos + 1
+                    return Token(c, c, self.lineno, pos)
+                t = Token('POLICYBODY', data[pos:stop], self.lineno, pos)
+                self.lineno += data.count('\n', pos, stop)
+                self.lexpos = stop
+                return t
+
+            elif kind == _CR:
+                m = CRLFS.match(data, pos)
+                if m is not None:
+                    self.lineno += (m.end() - pos) / 2
+                    pos = m.end()
+                    continue
+
+            elif kind == _LITERAL:
+                self.lexpos = pos + 1
+                return Token(c, c, self.lineno, pos)
+
+            # Nothing matches: report it the way the PLY lexer does.
+            t = LexToken()
+            t.value = c
+            t.lineno = self.lineno
+            t.type = 'error'
+            t.lexer = self
+            t.lexpos = pos
+            self.lexpos = pos
+            self.rules.t_error(t)
+            if self.lexpos == pos:
+                raise LexError("Scanning error. Illegal character '%s'" %
+                               c, data[pos:])
+            pos = self.lexpos
+        self.lexpos = pos + 1
+        return None
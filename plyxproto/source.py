@@ -0,0 +1,123 @@
+# Reading xproto sources.
+#
+# read_source() accepts a path, an open file object or a buffer and returns
+# the text in one piece, without building it up line by line. Large files are
+# mapped with mmap and copied out in a single slice; smaller ones are read in
+# one call. LineTable maps positions in a source back to lines and columns.
+
+import io
+import mmap
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_right
+
+# Files at least this large are read through mmap.
+MMAP_THRESHOLD = 1 << 20
+
+if sys.version_info[0] >= 3:
+    string_types = (str,)
+    buffer_types = (bytes, bytearray, memoryview, mmap.mmap)
+else:
+    string_types = (str, unicode)
+    buffer_types = (bytearray, memoryview, buffer, mmap.mmap)
+
+
+def _read_path(path):
+    with io.open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return m[:]
+            finally:
+                m.close()
+        return f.read()
+
+
+def _to_bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    if isinstance(data, mmap.mmap):
+        return data[:]
+    return bytes(data)
+
+
+def read_source(source, encoding=None):
+    '''
+    Return the contents of source, which may be a path, a file object or a
+    buffer (bytes on Python 3, bytearray, memoryview, buffer or mmap). On
+    Python 2 a str is taken to be a path, as parse_file always has.
+
+    Bytes are decoded with encoding when one is given. Without an encoding
+    they are returned as they are on Python 2 and decoded as UTF-8 on
+    Python 3. Text read from a text-mode file object is returned unchanged.
+    '''
+    if isinstance(source, string_types):
+        data = _read_path(source)
+    elif isinstance(source, buffer_types):
+        data = _to_bytes(source)
+    else:
+        data = source.read()
+
+    if isinstance(data, bytes):
+        if encoding is not None:
+            return data.decode(encoding)
+        if bytes is not str:
+            return data.decode('utf-8')
+    return data
+
+
+NEWLINE = re.compile('\n')
+
+
+class LineTable(object):
+    '''
+    The start offset of every line of a source text, for turning a lexpos
+    into (line, column) by bisection instead of rescanning the text.
+
+    lineno is the number of the first line and offset the lexpos of the
+    first character, so a table can describe text that the lexer saw behind
+    a prefix. Lines are counted at '\n' like the lexer counts them; columns
+    start at 1.
+    '''
+
+    def __init__(self, text, lineno=1, offset=0):
+        self.lineno = lineno
+        self.offset = offset
+        self.starts = array('I', [0])
+        self.starts.extend(m.end() for m in NEWLINE.finditer(text))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def position(self, lexpos):
+        pos = lexpos - self.offset
+        index = bisect_right(self.starts, pos) - 1
+        if index < 0:
+            index = 0
+        return (self.lineno + index, int(pos - self.starts[index]) + 1)
+
+    def edited(self, start, end, text):
+        '''
+        The table of the text this one describes with [start:end] (offsets
+        into the text, not lexpos) replaced by text. Only text is scanned;
+        the line starts after the edit are moved by its length.
+        '''
+        starts = self.starts
+        table = LineTable.__new__(LineTable)
+        table.lineno = self.lineno
+        table.offset = self.offset
+        table.starts = starts[:bisect_right(starts, start)]
+        table.starts.extend(m.end() + start for m in NEWLINE.finditer(text))
+        tail = starts[bisect_right(starts, end):]
+        delta = len(text) - (end - start)
+        if delta:
+            tail = array('I', [s + delta for s in tail])
+        table.starts.extend(tail)
+        return table
+
+    def line_start(self, line):
+        '''The lexpos of the first character of line.'''
+        return int(self.starts[line - self.lineno]) + self.offset
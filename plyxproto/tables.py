@@ -0,0 +1,297 @@
+# Parse table management for the xproto and FOL grammars.
+#
+# Tables are looked up in two places. The build step (`python -m
+# plyxproto.tables`, run by setup.py) freezes lextab/parsetab modules into the
+# package itself; they are used whenever their signature matches the grammar
+# in this tree. Otherwise each grammar gets its own table module in a per-user
+# cache directory. The module name embeds a digest of the grammar signature,
+# so two grammars never share a file and a changed grammar never picks up a
+# stale table. Tables are written to a temporary file and renamed into place,
+# so concurrent workers either see a complete table or none at all.
+#
+# The xproto grammar also gets a generated parser module (see lrgen), looked
+# up the same way: frozen as xproto_lrparser, else in the cache directory. Its
+# signature covers the grammar and the source of the module with the rules,
+# since the generated parser copies some of their actions.
+
+import hashlib
+import importlib
+import os
+import sys
+import tempfile
+
+import ply.lex as lex
+import ply.yacc as yacc
+
+CACHE_DIR_ENV = 'PLYXPROTO_CACHE_DIR'
+
+PACKAGE = __name__.rpartition('.')[0]
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def cache_dir():
+    path = os.environ.get(CACHE_DIR_ENV)
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'plyxproto')
+
+
+def _module_dict(module):
+    return dict((k, getattr(module, k)) for k in dir(module))
+
+
+def _reflect(module):
+    pinfo = yacc.ParserReflect(_module_dict(module), log=yacc.NullLogger())
+    pinfo.get_all()
+    return pinfo
+
+
+def _digest(pinfo, start):
+    sig = pinfo.signature()
+    if not isinstance(sig, bytes):
+        sig = sig.encode('utf-8')
+    digest = hashlib.sha1(sig)
+    if start:
+        digest.update(start.encode('latin-1'))
+    return digest.hexdigest()
+
+
+def grammar_signature(module, start=None):
+    return _digest(_reflect(module), start)
+
+
+def lexer_signature(module):
+    funcs = []
+    strings = []
+    for name in dir(module):
+        if not name.startswith('t_'):
+            continue
+        rule = getattr(module, name)
+        if callable(rule):
+            funcs.append((rule.__code__.co_firstlineno, name,
+                          getattr(rule, 'regex', rule.__doc__)))
+        else:
+            strings.append((name, rule))
+    funcs.sort()
+    spec = (list(module.tokens), getattr(module, 'literals', ''),
+            getattr(module, 'states', ()), [f[1:] for f in funcs],
+            sorted(strings))
+    return hashlib.sha1(repr(spec).encode('utf-8')).hexdigest()
+
+
+def module_source(module):
+    path = module.__file__
+    if path.endswith(('.pyc', '.pyo')) and os.path.exists(path[:-1]):
+        path = path[:-1]
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def generated_signature(module, start):
+    digest = hashlib.sha1(grammar_signature(module, start).encode('ascii'))
+    digest.update(module_source(sys.modules[type(module).__module__]))
+    return digest.hexdigest()
+
+
+def _packaged_table(tabname):
+    try:
+        return importlib.import_module('%s.%s' % (PACKAGE, tabname))
+    except Exception:
+        return None
+
+
+def _load_module(name, path):
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _writable_dir(path):
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    except OSError:
+        pass
+    return os.path.isdir(path) and os.access(path, os.W_OK)
+
+
+def build_lexer(module, name):
+    tabmodule = _packaged_table('%s_lextab' % name)
+    if getattr(tabmodule, '_lexsignature', None) == lexer_signature(module):
+        try:
+            return lex.lex(module=module, optimize=1, lextab=tabmodule)
+        except Exception:
+            pass
+    return lex.lex(module=module)
+
+
+def _read_table(tabmodule):
+    lr = yacc.LRTable()
+    lr.read_table(tabmodule)
+    return lr
+
+
+def _table_of(parser):
+    lr = yacc.LRTable()
+    lr.lr_action = parser.action
+    lr.lr_goto = parser.goto
+    lr.lr_productions = [
+        yacc.MiniProduction(p.str, p.name, p.len, p.func, p.file, p.line)
+        for p in parser.productions]
+    return lr
+
+
+# Tables are shared and never modified once built. make_parser() binds a
+# private copy of the production list to one module instance, so every
+# parser it returns can run independently of the others. cls is the parser
+# class: LRParser or a generated one (see build_generated).
+def make_parser(table, module, cls=yacc.LRParser):
+    lr = yacc.LRTable()
+    lr.lr_action = table.lr_action
+    lr.lr_goto = table.lr_goto
+    lr.lr_method = table.lr_method
+    lr.lr_productions = []
+    for p in table.lr_productions:
+        p = yacc.MiniProduction(p.str, p.name, p.len, p.func, p.file, p.line)
+        if p.func:
+            p.callable = getattr(module, p.func)
+        lr.lr_productions.append(p)
+    return cls(lr, getattr(module, 'p_error', None))
+
+
+def build_table(module, start, name, outputdir=None):
+    pinfo = _reflect(module)
+
+    tabmodule = _packaged_table('%s_parsetab' % name)
+    if tabmodule is not None and \
+            getattr(tabmodule, '_lr_signature', None) == pinfo.signature():
+        try:
+            return _read_table(tabmodule)
+        except Exception:
+            pass
+
+    if outputdir is None:
+        outputdir = cache_dir()
+    tabname = 'parsetab_%s_%s' % (name, _digest(pinfo, start))
+    path = os.path.join(outputdir, tabname + '.py')
+
+    if os.path.exists(path):
+        try:
+            return _read_table(_load_module(tabname, path))
+        except Exception:
+            pass
+
+    if not _writable_dir(outputdir):
+        return _table_of(yacc.yacc(module=module, start=start, debug=0,
+                                   write_tables=0))
+
+    # Let yacc write the table under a unique temporary module name, then
+    # publish it with an atomic rename.
+    fd, tmppath = tempfile.mkstemp(prefix='tmp_%s_' % name, suffix='.py',
+                                   dir=outputdir)
+    os.close(fd)
+    tmpname = os.path.basename(tmppath)[:-3]
+    try:
+        parser = yacc.yacc(module=module, start=start, debug=0,
+                           tabmodule=tmpname, outputdir=outputdir)
+        # Only publishing the table may fail quietly; the table is built.
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            pass
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+    return _table_of(parser)
+
+
+def _exec_module(name, source):
+    namespace = {'__name__': name}
+    exec(compile(source, name, 'exec'), namespace)
+    return namespace
+
+
+def build_generated(module, start, name, table, outputdir=None):
+    '''
+    The generated parser class (see lrgen) for table, the LR table built
+    from module. Pass it to make_parser.
+    '''
+    from . import lrgen
+
+    signature = generated_signature(module, start)
+    genmodule = _packaged_table('%s_lrparser' % name)
+    if getattr(genmodule, '_signature', None) == signature:
+        return genmodule.Parser
+
+    if outputdir is None:
+        outputdir = cache_dir()
+    modname = 'lrparser_%s_%s' % (name, signature)
+    path = os.path.join(outputdir, modname + '.py')
+
+    if os.path.exists(path):
+        try:
+            return _load_module(modname, path).Parser
+        except Exception:
+            pass
+
+    source = lrgen.generate(table, module, signature)
+    if not _writable_dir(outputdir):
+        return _exec_module(modname, source)['Parser']
+    fd, tmppath = tempfile.mkstemp(prefix='tmp_%s_' % name, suffix='.py',
+                                   dir=outputdir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(source)
+        os.rename(tmppath, path)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+    try:
+        return _load_module(modname, path).Parser
+    except Exception:
+        return _exec_module(modname, source)['Parser']
+
+
+def build_parser(module, start, name, outputdir=None):
+    return make_parser(build_table(module, start, name, outputdir), module)
+
+
+def grammars():
+    from .logicparser import FOLLexer, FOLParser
+    from .parser import ProtobufLexer, ProtobufParser
+    return [('xproto', ProtobufLexer(), ProtobufParser()),
+            ('fol', FOLLexer(), FOLParser())]
+
+
+def write_package_tables(outputdir=PACKAGE_DIR):
+    for name, lexmodule, parsemodule in grammars():
+        lextab = '%s_lextab' % name
+        lex.lex(module=lexmodule).writetab(lextab, outputdir)
+        with open(os.path.join(outputdir, lextab + '.py'), 'a') as f:
+            f.write('_lexsignature = %r\n' % lexer_signature(lexmodule))
+
+        parser = yacc.yacc(module=parsemodule, start='goal', debug=0,
+                           tabmodule='%s_parsetab' % name,
+                           outputdir=outputdir)
+        if name == 'xproto':
+            from . import lrgen
+            source = lrgen.generate(
+                _table_of(parser), parsemodule,
+                generated_signature(parsemodule, 'goal'))
+            with open(os.path.join(outputdir, '%s_lrparser.py' % name),
+                      'w') as f:
+                f.write(source)
+
+
+if __name__ == '__main__':
+    write_package_tables(*sys.argv[1:])
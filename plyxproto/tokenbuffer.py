@@ -0,0 +1,115 @@
+# Compact token streams.
+#
+# A TokenBuffer holds a whole token stream in four arrays (type id, lexpos,
+# end position and line number) next to the source text, instead of one
+# LexToken object per token. Token values are sliced from the source when
+# asked for. Buffers can be scanned by tooling (highlighting, searching by
+# token, formatting) and fed straight to the parser through tokenfunc.
+
+from array import array
+
+from ply.lex import LexToken
+
+from .parser import ProtobufLexer
+
+# Token type names by id: the declared tokens, then the literal characters.
+TYPES = tuple(ProtobufLexer.tokens) + tuple(
+    c for c in ProtobufLexer.literals if c not in ProtobufLexer.tokens)
+TYPE_IDS = dict((name, i) for i, name in enumerate(TYPES))
+# Ids of the types the NAME rule produces: identifiers and keywords.
+NAME_IDS = frozenset(TYPE_IDS[k.upper()] for k in ProtobufLexer.keywords) | \
+    frozenset([TYPE_IDS['NAME']])
+
+
+class TokenBuffer(object):
+
+    def __init__(self, data, lineno=1):
+        self.data = data
+        self.start_lineno = lineno
+        self.types = array('H')
+        self.lexpos = array('I')
+        self.ends = array('I')
+        self.lineno = array('I')
+        self.diagnostics = []
+
+    @classmethod
+    def from_lexer(cls, lexer, data, lineno=1):
+        '''
+        Tokenize data with lexer (a clone is used, lexer itself is left
+        alone) and return the resulting buffer. Lexical errors are
+        collected in its diagnostics list instead of being printed.
+        '''
+        buf = cls(data, lineno)
+        lexer = lexer.clone()
+        lexer.lineno = lineno
+        lexer.diagnostics = buf.diagnostics
+        lexer.input(data)
+        token = lexer.token
+        types = buf.types.append
+        lexpos = buf.lexpos.append
+        ends = buf.ends.append
+        linenos = buf.lineno.append
+        ids = TYPE_IDS
+        t = token()
+        while t is not None:
+            types(ids[t.type])
+            lexpos(t.lexpos)
+            ends(t.lexpos + len(t.value))
+            linenos(t.lineno)
+            t = token()
+        return buf
+
+    def __len__(self):
+        return len(self.types)
+
+    def type(self, i):
+        return TYPES[self.types[i]]
+
+    def value(self, i):
+        return self.data[self.lexpos[i]:self.ends[i]]
+
+    # array('I') items come back as long on Python 2; int() keeps token
+    # positions, and the spans built from them, plain ints.
+    def token(self, i, offset=0):
+        t = LexToken()
+        t.type = TYPES[self.types[i]]
+        t.value = self.data[self.lexpos[i]:self.ends[i]]
+        t.lineno = int(self.lineno[i])
+        t.lexpos = int(self.lexpos[i] + offset)
+        return t
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('token index out of range')
+        return self.token(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.token(i)
+
+    def tokenfunc(self, lead=(), offset=0, names=None):
+        '''
+        Return a callable that hands out the tokens one at a time, for the
+        tokenfunc argument of the PLY parser. The tokens in lead come first;
+        buffered tokens have offset added to their lexpos, and identifiers
+        are interned in names (a NameTable) if one is given.
+        '''
+        lead = list(lead)
+        state = [0]
+        count = len(self)
+        types = self.types
+
+        def next_token():
+            if lead:
+                return lead.pop(0)
+            i = state[0]
+            if i >= count:
+                return None
+            state[0] = i + 1
+            t = self.token(i, offset)
+            if names is not None and types[i] in NAME_IDS:
+                t.value = names.intern(t.value)
+            return t
+        return next_token
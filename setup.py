@@ -7,7 +7,27 @@ https://github.com/sb98052/plyprotobuf
 https://github.com/opencord/xos
 """
 
+import os
+import subprocess
+import sys
+
 from setuptools import setup
+from setuptools.command.build_py import build_py
+
+
+class BuildPyCommand(build_py):
+    """Freeze the lexer and parser tables into the package before building."""
+
+    def run(self):
+        try:
+            subprocess.check_call(
+                [sys.executable, '-m', 'plyxproto.tables'],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        except (OSError, subprocess.CalledProcessError):
+            self.warn('unable to generate parse tables, '
+                      'they will be built at runtime')
+        build_py.run(self)
+
 
 setup(
     name='plyxproto',
@@ -26,4 +46,5 @@ setup(
         'Programming Language :: Python :: 2.7'],
     keywords='xproto protobuf xos parser',
     packages=['plyxproto'],
+    cmdclass={'build_py': BuildPyCommand},
     install_requires=['ply'])